@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Tools to pass acquisition blocks between threads
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+QueuePolicies = ('block', 'drop-oldest', 'drop-newest')
+# Min time (s) between the warnings of the dropped blocks of a queue
+DropLogInterval = 1
+
+
+class BlockQueue():
+    def __init__(self, Depth=8, Policy='drop-oldest', Name=''):
+        '''Bounded single producer single consumer queue of data blocks
+           Depth: int. Maximum number of blocks waiting to be consumed
+           Policy: str. What to do when a block arrives and the queue is full
+                        'block': the producer waits for a free slot
+                        'drop-oldest': the oldest pending block is discarded
+                        'drop-newest': the incoming block is discarded
+           Name: str. Used to identify the queue in the warnings, that
+                      are logged at most every DropLogInterval, see the
+                      Dropped counter for the exact number
+        '''
+        if Policy not in QueuePolicies:
+            raise ValueError('Unknown queue policy {}'.format(Policy))
+        self.Depth = int(Depth)
+        self.Policy = Policy
+        self.Name = Name
+        self.Blocks = deque()
+        self.Cond = threading.Condition()
+        self.Closed = False
+        self.Woken = False
+
+        self.Enqueued = 0
+        self.Dropped = 0
+        self.HighWater = 0
+        self.LastDropLog = None
+        self.DropsLogged = 0
+
+    def Put(self, Block):
+        '''Adds a block to the queue following the overflow policy.
+           Returns False if a block was dropped
+        '''
+        with self.Cond:
+            Dropped = False
+            if len(self.Blocks) >= self.Depth:
+                if self.Policy == 'block':
+                    while len(self.Blocks) >= self.Depth and not self.Closed:
+                        self.Cond.wait()
+                elif self.Policy == 'drop-oldest':
+                    self.Blocks.popleft()
+                    Dropped = True
+                else:
+                    Dropped = True
+
+            if Dropped:
+                self.Dropped += 1
+                self._LogDrops()
+
+            if not Dropped or self.Policy == 'drop-oldest':
+                self.Blocks.append(Block)
+                self.Enqueued += 1
+                self.HighWater = max(self.HighWater, len(self.Blocks))
+                self.Cond.notify_all()
+            return not Dropped
+
+    def _LogDrops(self):
+        Now = time.monotonic()
+        if (self.LastDropLog is not None and
+                Now - self.LastDropLog < DropLogInterval):
+            return
+        log.warning('%s queue full, %d blocks dropped, %d in total',
+                    self.Name, self.Dropped - self.DropsLogged, self.Dropped)
+        self.LastDropLog = Now
+        self.DropsLogged = self.Dropped
+
+    def Get(self, Wait=False, Timeout=None):
+        '''Returns the oldest pending block or None if the queue is empty
+           Wait: bool. If True waits until a block arrives, the queue is
+                       closed or woken up or Timeout (s) expires
+        '''
+        with self.Cond:
+            if Wait:
+                self.Cond.wait_for(lambda: (self.Blocks or self.Closed or
+                                            self.Woken), Timeout)
+            self.Woken = False
+            if not self.Blocks:
+                return None
+            Block = self.Blocks.popleft()
+            self.Cond.notify_all()
+            return Block
+
+    def Wake(self):
+        '''Returns a waiting Get without a block, so the consumer loop runs
+           once
+        '''
+        with self.Cond:
+            self.Woken = True
+            self.Cond.notify_all()
+
+    def Close(self):
+        '''Wakes up the waiting threads. Pending blocks can still be read
+        '''
+        with self.Cond:
+            self.Closed = True
+            self.Cond.notify_all()
+
+    def __len__(self):
+        return len(self.Blocks)
+
+    def GetCounters(self):
+        return {'Enqueued': self.Enqueued,
+                'Dropped': self.Dropped,
+                'HighWater': self.HighWater,
+                'Depth': len(self.Blocks)}
+
+
+class DataBlock(np.ndarray):
+    def __new__(subtype, Data, StartInd=None, AcqTime=None, SeqNum=None):
+        '''Block of samples with its provenance, it is a view of Data so
+           it can be used as a plain ndarray by all the stages
+           Data: array. (samples, channels)
+           StartInd: int. Index of the first sample since the start of the
+                          acquisition
+           AcqTime: float. Wall clock time (time.time()) when the block was
+                           read from the card, now if None
+           SeqNum: int. Sequence number of the block, consecutive blocks
+                        of an acquisition have consecutive numbers
+        '''
+        obj = np.asarray(Data).view(subtype)
+        obj.StartInd = StartInd
+        obj.AcqTime = time.time() if AcqTime is None else AcqTime
+        obj.SeqNum = SeqNum
+        obj.PoolOwner = None
+        return obj
+
+    def __array_finalize__(self, obj):
+        # Slices and results keep the provenance of the original block
+        if obj is None:
+            return
+        self.StartInd = getattr(obj, 'StartInd', None)
+        self.AcqTime = getattr(obj, 'AcqTime', None)
+        self.SeqNum = getattr(obj, 'SeqNum', None)
+        self.PoolOwner = getattr(obj, 'PoolOwner', None)
+
+
+class BlockPool():
+    def __init__(self, Size, Shape, dtype=float):
+        '''Rotating pool of preallocated buffers for a producer that must
+           not allocate. Next returns a new DataBlock view of the following
+           buffer, so a buffer is overwritten Size blocks later. Each
+           buffer keeps the tag of its last block, IsOverrun tells if the
+           samples of a block were already overwritten.
+           Size: int. Number of buffers
+           Shape: tuple. Shape of each buffer, (samples, channels)
+        '''
+        self.Buffers = np.zeros((Size, ) + tuple(Shape), dtype=dtype)
+        self.Owners = np.full(Size, -1, dtype=np.int64)
+        self.Ind = 0
+        self.Count = 0
+
+    def __len__(self):
+        return self.Buffers.shape[0]
+
+    def Next(self, nSamps=None, **Provenance):
+        '''Returns the next buffer as a DataBlock, the caller writes it
+           nSamps: int. Samples of the block, all the buffer if None
+           Provenance: StartInd, AcqTime and SeqNum of the DataBlock
+        '''
+        Slot = self.Ind
+        self.Ind = (Slot + 1) % self.Buffers.shape[0]
+        self.Owners[Slot] = self.Count
+        Block = DataBlock(self.Buffers[Slot, :nSamps], **Provenance)
+        Block.PoolOwner = (self.Owners, Slot, self.Count)
+        self.Count += 1
+        return Block
+
+
+def IsOverrun(Block):
+    '''True if Block comes from a BlockPool and its buffer has been
+       reused for a newer block, so its samples are not valid anymore
+    '''
+    Owner = getattr(Block, 'PoolOwner', None)
+    if Owner is None:
+        return False
+    Owners, Slot, Tag = Owner
+    return Owners[Slot] != Tag
+
+
+def GetBlockAge(Block):
+    '''Seconds since the acquisition of a DataBlock, None for plain arrays
+    '''
+    AcqTime = getattr(Block, 'AcqTime', None)
+    if AcqTime is None:
+        return None
+    return time.time() - AcqTime
+
+
+def ScaleRaw(Block, Coeffs, Out=None):
+    '''Converts the raw ADC codes of a block to volts with the polynomial
+       scaling coefficients of each channel, v = c0 + c1*x + c2*x**2 ...
+       Block: array. (samples, channels) raw codes, int16
+       Coeffs: array. (channels, coefficients) in increasing order, as
+                      given by ReadAnalog.ScalingCoeffs. If None the block
+                      is returned as it is
+       Out: array. (samples, channels) float array to write the result,
+                   if None a new float64 array is returned
+    '''
+    if Coeffs is None:
+        return Block
+    Coeffs = np.asarray(Coeffs)
+    if Out is None:
+        Out = np.empty(Block.shape, dtype=np.float64)
+    Out[...] = Coeffs[..., -1]
+    for ic in range(Coeffs.shape[-1] - 2, -1, -1):
+        Out *= Block
+        Out += Coeffs[..., ic]
+    return Out
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Selection of the DAQ implementation. Every backend module provides
+
+    GetDevName()
+    ReadAnalog(InChans, Range=5.0, Diff=False, RawInt16=False, **SimKwargs)
+        .EveryNEvent, .DoneEvent, .ScalingCoeffs, .dtype
+        .ReadData(Fs, nSamps, EverySamps)
+        .ReadContData(Fs, EverySamps, PoolSize=32)
+        .StopContData()
+    WriteAnalog(Channels)
+        .SetVal(value), .SetSignal(Signal, nSamps),
+        .SetContSignal(Signal, nSamps)
+    WriteDigital(Channels)
+        .SetDigitalSignal(Signal), .SetContSignal(Signal)
+"""
+
+import importlib
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+DaqBackends = {'daqmx': 'PyqtTools.DaqInterface',
+               'simulated': 'PyqtTools.DaqSimulated',
+               }
+
+
+def LoadBackend(Name=None):
+    '''Returns the module of a DAQ backend
+       Name: str. 'daqmx', 'simulated' or 'auto'. If None it is read from
+                  the environment variable PYQTTOOLS_DAQ, by default 'auto'
+                  that uses daqmx if PyDAQmx can be loaded and the
+                  simulated card otherwise
+
+       Daq = LoadBackend()
+       # The arguments of the simulated signals are ignored by daqmx
+       AnalogIn = Daq.ReadAnalog(['ai0', 'ai1'], Fcs=[30e3, ])
+    '''
+    if Name is None:
+        Name = os.environ.get('PYQTTOOLS_DAQ', 'auto')
+    if Name == 'auto':
+        try:
+            return importlib.import_module(DaqBackends['daqmx'])
+        except (ImportError, OSError, NotImplementedError) as e:
+            log.warning('DAQmx not available (%s), using simulated card', e)
+            Name = 'simulated'
+    if Name not in DaqBackends:
+        raise ValueError('Unknown DAQ backend {}'.format(Name))
+    return importlib.import_module(DaqBackends[Name])
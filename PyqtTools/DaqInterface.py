@@ -11,10 +11,19 @@ import sys
 import ctypes
 from ctypes import byref, c_int32
 import numpy as np
+import logging
+import time
+
+from PyqtTools.BlockModule import DataBlock, BlockPool
+
+
+log = logging.getLogger(__name__)
+
+nScalingCoeffs = 4
 
 
 def GetDevName():
-    print('ReadAnalog GetDevName')
+    log.debug('ReadAnalog GetDevName')
     # Get Device Name of Daq Card
     n = 1024
     buff = ctypes.create_string_buffer(n)
@@ -32,7 +41,7 @@ def GetDevName():
         Dev = dev + '/{}'
 
     if Dev is None:
-        print('ERRROORR dev not found ', value)
+        log.error('Dev not found %s', value)
 
     return Dev
 
@@ -44,9 +53,30 @@ class ReadAnalog(Daq.Task):
     EveryNEvent = None
     DoneEvent = None
 
-    def __init__(self, InChans, Range=5.0, Diff=False):
+    def __init__(self, InChans, Range=5.0, Diff=False, RawInt16=False,
+                 **SimKwargs):
+        '''Analog input task
+           InChans: list. Channel names ['ai0', 'ai1']
+           Range: float. Input range (V)
+           Diff: bool. Differential instead of referenced single ended
+           RawInt16: bool. The blocks are the int16 codes of the ADC, to
+                           be converted to volts with BlockModule.ScaleRaw
+                           and ScalingCoeffs. ScalingCoeffs is None when
+                           the blocks are already volts
+           SimKwargs: arguments of DaqSimulated.ReadAnalog, ignored so the
+                      same call works with both backends
+        '''
+        if SimKwargs:
+            log.debug('ReadAnalog ignores %s', ', '.join(SimKwargs))
         Daq.Task.__init__(self)
         self.Channels = InChans
+        self.RawInt16 = RawInt16
+        self.ContSamps = False
+        self.SampsRead = c_int32()
+        if RawInt16:
+            self.dtype = np.int16
+        else:
+            self.dtype = np.float64
 
         Dev = GetDevName()
         for Ch in self.Channels:
@@ -61,14 +91,31 @@ class ReadAnalog(Daq.Task):
                                          -Range, Range,
                                          Daq.DAQmx_Val_Volts, None)
 
+        # Polynomial coefficients from codes to volts (channels, nCoeffs)
+        self.ScalingCoeffs = None
+        if RawInt16:
+            self.ScalingCoeffs = np.zeros((len(self.Channels),
+                                           nScalingCoeffs))
+            for ic, Ch in enumerate(self.Channels):
+                self.GetAIDevScalingCoeff(Dev.format(Ch),
+                                          self.ScalingCoeffs[ic, :],
+                                          nScalingCoeffs)
+
         self.AutoRegisterDoneEvent(0)
 
     def ReadData(self, Fs=1000, nSamps=10000, EverySamps=1000):
-
+        '''Finite acquisition of nSamps samples, the blocks are read in
+           place in the preallocated array data, DoneEvent receives the
+           samples read
+        '''
         self.Fs = Fs
         self.EverySamps = EverySamps
+        self.ContSamps = False
 
-        self.data = np.ndarray([len(self.Channels), ])
+        self.data = np.empty((nSamps, len(self.Channels)), dtype=self.dtype)
+        self.nRead = 0
+        self.SeqNum = 0
+        self.StartInd = 0
 
         self.CfgSampClkTiming("", Fs, Daq.DAQmx_Val_Rising,
                               Daq.DAQmx_Val_FiniteSamps, nSamps)
@@ -77,11 +124,24 @@ class ReadAnalog(Daq.Task):
                                             self.EverySamps, 0)
         self.StartTask()
 
-    def ReadContData(self, Fs, EverySamps):
+    def ReadContData(self, Fs, EverySamps, PoolSize=32):
+        '''Continuous acquisition, the blocks passed to EveryNEvent rotate
+           over a BlockPool of PoolSize preallocated buffers, so a block
+           is overwritten PoolSize callbacks later. Each callback passes a
+           new DataBlock view with the sample index, acquisition time and
+           sequence number of its read, consumers that can hold blocks
+           longer check them with BlockModule.IsOverrun
+        '''
         self.Fs = Fs
         self.EverySamps = np.int32(EverySamps)
         self.ContSamps = True
 
+        self.Pool = BlockPool(PoolSize,
+                              (self.EverySamps, len(self.Channels)),
+                              dtype=self.dtype)
+        self.SeqNum = 0
+        self.StartInd = 0
+
         self.CfgSampClkTiming("", Fs, Daq.DAQmx_Val_Rising,
                               Daq.DAQmx_Val_ContSamps,
                               self.EverySamps)
@@ -97,20 +157,32 @@ class ReadAnalog(Daq.Task):
         self.ContSamps = False
 
     def EveryNCallback(self):
-        print('Every')
-        read = c_int32()
-        data = np.zeros((self.EverySamps, len(self.Channels)))
-        self.ReadAnalogF64(self.EverySamps, 10.0,
-                           Daq.DAQmx_Val_GroupByScanNumber,
-                           data, data.size, byref(read), None)
-
-        print('EveryN')
-
-        # if not self.ContSamps:
-        self.data = np.vstack((self.data, data))
+        if self.ContSamps:
+            data = self.Pool.Next(StartInd=self.StartInd,
+                                  SeqNum=self.SeqNum)
+        else:
+            data = DataBlock(self.data[self.nRead:self.nRead +
+                                       self.EverySamps, :],
+                             StartInd=self.StartInd,
+                             SeqNum=self.SeqNum)
+
+        if self.RawInt16:
+            self.ReadBinaryI16(self.EverySamps, 10.0,
+                               Daq.DAQmx_Val_GroupByScanNumber,
+                               data, data.size, byref(self.SampsRead), None)
+        else:
+            self.ReadAnalogF64(self.EverySamps, 10.0,
+                               Daq.DAQmx_Val_GroupByScanNumber,
+                               data, data.size, byref(self.SampsRead), None)
+        log.debug('EveryN read %d samples', self.SampsRead.value)
+        data.AcqTime = time.time()
+        self.StartInd += self.SampsRead.value
+        self.SeqNum += 1
+
+        if not self.ContSamps:
+            self.nRead += self.SampsRead.value
 
         if self.EveryNEvent:
-            print('Call')
             self.EveryNEvent(data)
 
     def DoneCallback(self, status):
@@ -118,7 +190,7 @@ class ReadAnalog(Daq.Task):
         self.UnregisterEveryNSamplesEvent()
 
         if self.DoneEvent:
-            self.DoneEvent(self.data[1:, :])
+            self.DoneEvent(self.data[:self.nRead, :])
 
         return 0  # The function should return an integer
 
@@ -187,14 +259,13 @@ class WriteDigital(Daq.Task):
         self.StopTask()
 
     def SetDigitalSignal(self, Signal):
-        print('SetDigSignal', Signal, Signal.shape)
+        log.debug('SetDigSignal %s %s', Signal, Signal.shape)
         Sig = np.array(Signal, dtype=np.uint8)
-        print(Sig, 'SIGNAL')
         self.WriteDigitalLines(1, 1, 10.0, Daq.DAQmx_Val_GroupByChannel,
                                Sig, None, None)
 
     def SetContSignal(self, Signal):
-        print('SetContSignal')
+        log.debug('SetContSignal')
         read = c_int32()
         self.CfgSampClkTiming('ai/SampleClock', 1, Daq.DAQmx_Val_Rising,
                               Daq.DAQmx_Val_ContSamps, Signal.shape[1])
@@ -203,7 +274,7 @@ class WriteDigital(Daq.Task):
                                Daq.DAQmx_Val_GroupByChannel,
                                Signal, byref(read), None)
         self.StartTask()
-        print('End SetSingal', read)
+        log.debug('End SetSignal %d', read.value)
 
 ##############################################################################
 
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated DAQ card with the interface of DaqInterface, generates noise,
+1/f noise and AM modulated carriers with numpy
+"""
+
+import threading
+import time
+import logging
+import numpy as np
+from scipy.signal import lfilter
+
+from PyqtTools.BlockModule import DataBlock, BlockPool
+
+
+log = logging.getLogger(__name__)
+
+nScalingCoeffs = 4
+
+# IIR approximation of a 1/f spectrum from white noise
+PinkB = np.array([0.049922035, -0.095993537, 0.050612699, -0.004408786])
+PinkA = np.array([1, -2.494956002, 2.017265875, -0.522189400])
+PinkGain = 0.0862  # Output rms for a unit rms white noise input
+
+
+def GetDevName():
+    return 'Sim1/{}'
+
+
+class SignalGenerator():
+    def __init__(self, nChannels, Fs, Fcs=(), CarrierAmp=0.1, ModFreq=10,
+                 ModDepth=0.5, NoiseRms=1e-3, PinkRms=0, Offset=0,
+                 Seed=None):
+        '''Phase continuous multichannel test signals
+           nChannels: int. Number of channels
+           Fs: float. Sampling frequency
+           Fcs: list. Carrier frequencies added to all the channels
+           CarrierAmp: float. Amplitude (V) of each carrier
+           ModFreq: float. Amplitude modulation frequency of the carriers,
+                           the channel i is modulated at ModFreq*(1+i/10)
+           ModDepth: float. Amplitude modulation depth, 0 to 1
+           NoiseRms: float. Rms (V) of the white noise
+           PinkRms: float. Rms (V) of the 1/f noise
+           Offset: float. DC level (V)
+           Seed: int. Seed of the noise generator
+        '''
+        self.nChannels = nChannels
+        self.Fs = float(Fs)
+        self.Fcs = np.array(Fcs, dtype=float)
+        self.CarrierAmp = CarrierAmp
+        self.ModFreqs = ModFreq*(1 + np.arange(nChannels)/10.)
+        self.ModDepth = ModDepth
+        self.NoiseRms = NoiseRms
+        self.PinkRms = PinkRms
+        self.Offset = Offset
+        self.Rng = np.random.default_rng(Seed)
+        self.SampInd = 0
+        self.PinkZi = np.zeros((PinkA.size - 1, nChannels))
+
+    def Block(self, nSamps, Out=None):
+        '''Returns the next nSamps samples (nSamps, nChannels)
+        '''
+        if Out is None:
+            Out = np.empty((nSamps, self.nChannels))
+        t = (self.SampInd + np.arange(nSamps))/self.Fs
+        self.SampInd += nSamps
+
+        Out[:, :] = self.Offset
+        if self.Fcs.size:
+            Carriers = np.cos(2*np.pi*t[:, None]*self.Fcs[None, :])
+            Carriers = self.CarrierAmp*Carriers.sum(axis=1)
+            Mod = 1 + self.ModDepth*np.sin(2*np.pi*t[:, None] *
+                                           self.ModFreqs[None, :])
+            Out += Mod*Carriers[:, None]
+        if self.NoiseRms:
+            Out += self.Rng.normal(0, self.NoiseRms, Out.shape)
+        if self.PinkRms:
+            White = self.Rng.normal(0, self.PinkRms/PinkGain, Out.shape)
+            Pink, self.PinkZi = lfilter(PinkB, PinkA, White,
+                                        axis=0, zi=self.PinkZi)
+            Out += Pink
+        return Out
+
+
+class ReadAnalog():
+
+    EveryNEvent = None
+    DoneEvent = None
+
+    def __init__(self, InChans, Range=5.0, Diff=False, RawInt16=False,
+                 RealTime=True, **SignalKwargs):
+        '''Simulated analog input task, same interface than
+           DaqInterface.ReadAnalog. The blocks are generated in a thread
+           that calls EveryNEvent and DoneEvent.
+           RealTime: bool. If True the blocks are delivered at the
+                           acquisition rate, if False as fast as possible
+           SignalKwargs: arguments of SignalGenerator
+                         {'Fcs': [30e3, 35e3], 'NoiseRms': 1e-3}
+        '''
+        self.Channels = InChans
+        self.Range = Range
+        self.RawInt16 = RawInt16
+        self.RealTime = RealTime
+        self.SignalKwargs = SignalKwargs
+        self.ContSamps = False
+        self.Thread = None
+        self.Running = False
+        self.ScalingCoeffs = None
+        if RawInt16:
+            self.dtype = np.int16
+            self.ScalingCoeffs = np.zeros((len(self.Channels),
+                                           nScalingCoeffs))
+            self.ScalingCoeffs[:, 1] = Range/32767.
+        else:
+            self.dtype = np.float64
+
+    def _Start(self, Fs):
+        self.Fs = Fs
+        self.Generator = SignalGenerator(len(self.Channels), Fs,
+                                         **self.SignalKwargs)
+        self.VoltBlock = np.empty((self.EverySamps, len(self.Channels)))
+        self.SeqNum = 0
+        self.StartInd = 0
+        self.Running = True
+        self.Thread = threading.Thread(target=self._Run, daemon=True)
+        self.Thread.start()
+
+    def ReadData(self, Fs=1000, nSamps=10000, EverySamps=1000):
+        self.EverySamps = EverySamps
+        self.ContSamps = False
+        self.nSamps = nSamps
+        self.data = np.empty((nSamps, len(self.Channels)), dtype=self.dtype)
+        self.nRead = 0
+        self._Start(Fs)
+
+    def ReadContData(self, Fs, EverySamps, PoolSize=32):
+        self.EverySamps = int(EverySamps)
+        self.ContSamps = True
+        self.Pool = BlockPool(PoolSize,
+                              (self.EverySamps, len(self.Channels)),
+                              dtype=self.dtype)
+        self._Start(Fs)
+
+    def StopContData(self):
+        self.Running = False
+        if (self.Thread is not None and
+                self.Thread is not threading.current_thread()):
+            self.Thread.join()
+        self.ContSamps = False
+
+    def _Run(self):
+        Period = self.EverySamps/float(self.Fs)
+        Next = time.perf_counter() + Period
+        while self.Running:
+            if not self.ContSamps and \
+                    self.nRead + self.EverySamps > self.nSamps:
+                self.DoneCallback(0)
+                break
+            if self.RealTime:
+                Wait = Next - time.perf_counter()
+                if Wait > 0:
+                    time.sleep(Wait)
+                Next += Period
+            self.EveryNCallback()
+
+    def EveryNCallback(self):
+        if self.ContSamps:
+            data = self.Pool.Next(StartInd=self.StartInd,
+                                  SeqNum=self.SeqNum)
+        else:
+            data = DataBlock(self.data[self.nRead:self.nRead +
+                                       self.EverySamps, :],
+                             StartInd=self.StartInd,
+                             SeqNum=self.SeqNum)
+
+        if self.RawInt16:
+            Volts = self.Generator.Block(self.EverySamps, self.VoltBlock)
+            Volts *= 32767./self.Range
+            np.clip(Volts, -32768, 32767, out=Volts)
+            np.rint(Volts, out=Volts)
+            data[:, :] = Volts
+        else:
+            self.Generator.Block(self.EverySamps, data)
+        log.debug('EveryN read %d samples', self.EverySamps)
+        data.AcqTime = time.time()
+        self.StartInd += self.EverySamps
+        self.SeqNum += 1
+
+        if not self.ContSamps:
+            self.nRead += self.EverySamps
+
+        if self.EveryNEvent:
+            self.EveryNEvent(data)
+
+    def DoneCallback(self, status):
+        self.Running = False
+        if self.DoneEvent:
+            self.DoneEvent(self.data[:self.nRead, :])
+        return 0
+
+    def StopTask(self):
+        self.StopContData()
+
+    def ClearTask(self):
+        self.StopContData()
+
+
+class WriteAnalog():
+    def __init__(self, Channels):
+        '''Simulated analog output, keeps the last values written
+        '''
+        self.Channels = Channels
+        self.Value = None
+        self.Signal = None
+
+    def SetVal(self, value):
+        log.debug('SetVal %s', value)
+        self.Value = value
+
+    def SetSignal(self, Signal, nSamps):
+        self.Signal = Signal
+
+    def SetContSignal(self, Signal, nSamps):
+        self.Signal = Signal
+
+    def StopTask(self):
+        pass
+
+    def ClearTask(self):
+        pass
+
+
+class WriteDigital():
+    def __init__(self, Channels):
+        '''Simulated digital output, keeps the last signal written
+        '''
+        self.Channels = Channels
+        self.Signal = None
+
+    def SetDigitalSignal(self, Signal):
+        log.debug('SetDigSignal %s', Signal)
+        self.Signal = np.array(Signal, dtype=np.uint8)
+
+    def SetContSignal(self, Signal):
+        self.Signal = Signal
+
+    def StopTask(self):
+        pass
+
+    def ClearTask(self):
+        pass
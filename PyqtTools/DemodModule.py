@@ -9,6 +9,14 @@ import pyqtgraph.parametertree.parameterTypes as pTypes
 
 from scipy import signal
 import numpy as np
+from fractions import Fraction
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict
+
+from PyqtTools.BlockModule import BlockQueue, BlockPool, ScaleRaw, IsOverrun
+from PyqtTools.MetricsModule import StageMetrics
+from PyqtTools.ProfilerModule import ThreadProfiler
 
 DemodulParams = ({'name': 'DemodConfig',
                   'type': 'group',
@@ -37,6 +45,16 @@ DemodulParams = ({'name': 'DemodConfig',
                                 'title': 'Filter Order',
                                 'type': 'int',
                                 'value': 2},
+                               {'name': 'DecimMode',
+                                'title': 'Decimation',
+                                'type': 'list',
+                                'values': ['IIR', 'MultiStage'],
+                                'value': 'IIR'},
+                               {'name': 'Engine',
+                                'title': 'Demod Engine',
+                                'type': 'list',
+                                'values': ['Mixer', 'Channelizer'],
+                                'value': 'Mixer'},
                                {'name': 'OutType',
                                 'title': 'Output Var Type',
                                 'type': 'list',
@@ -58,14 +76,15 @@ class DemodParameters(pTypes.GroupParameter):
         self.DSFact = self.DemConfig.param('DSFact')
         self.on_DSFact_changed()
         self.FsDem.sigValueChanged.connect(self.on_FsDem_changed)
+        self.DSFact.sigValueChanged.connect(self.on_DSFact_changed)
         self.FiltOrder = self.DemConfig.param('FiltOrder')
         self.OutType = self.DemConfig.param('OutType')
 
     def ReCalc_DSFact(self, BufferSize):
-        while BufferSize % self.DSFact.value() != 0:
-            self.DSFact.setValue(self.DSFact.value()+1)
+        '''The decimation keeps its phase between blocks, so DSFact does not
+           need to divide BufferSize anymore. Only DSFs is updated
+        '''
         self.on_DSFact_changed()
-        print('DSFactChangedTo'+str(self.DSFact.value()))
 
     def on_FsDem_changed(self):
         self.on_DSFact_changed()
@@ -80,6 +99,8 @@ class DemodParameters(pTypes.GroupParameter):
            {'FsDemod': 500000.0,
             'DSFact': 100,
             'FiltOrder': 2,
+            'DecimMode': 'IIR',
+            'Engine': 'Mixer',
             'OutType': 'Abs'}
         '''
         Demod = {}
@@ -114,7 +135,7 @@ class DemodParameters(pTypes.GroupParameter):
 
 
 class Filter():
-    def __init__(self, Fs, Freqs, btype, Order):
+    def __init__(self, Fs, Freqs, btype, Order, nChannels=None, Axis=0):
         freqs = np.array(Freqs)/(0.5*Fs)
         self.b, self.a = signal.butter(Order,
                                        freqs,
@@ -123,19 +144,262 @@ class Filter():
         self.zi = signal.lfilter_zi(self.b,
                                     self.a,
                                     )
+        self.Axis = Axis
+        if nChannels is not None and Axis == 0:
+            # one state column per channel to filter 2D signals on axis 0
+            self.zi = np.repeat(self.zi[:, None], nChannels, axis=1)
+        elif nChannels is not None:
+            # one state row per channel, channels in rows of samples
+            self.zi = np.repeat(self.zi[None, :], nChannels, axis=0)
 
     def Apply(self, Sig):
         sigout, self.zi = signal.lfilter(b=self.b,
                                          a=self.a,
                                          x=Sig,
-                                         axis=0,
+                                         axis=self.Axis,
                                          zi=self.zi
                                          )
         return sigout
 
 
+CarrierTables = OrderedDict()
+MaxCarrierTables = 32
+
+
+def GetCarrierTable(Fc, Fs, Period, Size):
+    '''Returns a cached table of at least Size samples of
+       exp(-j*2*pi*Fc*n/Fs), which repeats every Period samples.
+       The cache keeps the MaxCarrierTables last used tables.
+    '''
+    Key = (Fc, Fs)
+    Table = CarrierTables.get(Key)
+    if Table is None or Table.shape[0] < Size:
+        nPeriods = -(-Size//Period)
+        n = np.arange(Period)
+        Table = np.tile(np.exp(-2j*np.pi*Fc*n/Fs), nPeriods)
+        CarrierTables[Key] = Table
+    CarrierTables.move_to_end(Key)
+    while len(CarrierTables) > MaxCarrierTables:
+        CarrierTables.popitem(last=False)
+    return Table
+
+
+# Bytes of the mixed signals filtered at once by DemodBatch, kept in cache
+DemodTileBytes = 2**20
+
+
+def ReserveCarrierTables(nTables):
+    '''Grows the cache of GetCarrierTable to keep at least nTables tables,
+       so the carriers used at each block do not evict each other
+    '''
+    global MaxCarrierTables
+    MaxCarrierTables = max(MaxCarrierTables, nTables)
+
+
+class NCO():
+    def __init__(self, Fc, Fs, MaxPeriod=2**16):
+        '''Numerically controlled oscillator that generates the complex
+           carrier exp(-j*2*pi*Fc*t) used to demodulate, phase continuous
+           between blocks of any length. t is counted from the first sample.
+           Fc: float. Carrier frequency
+           Fs: float. Sampling Frequency
+           MaxPeriod: int. If the carrier repeats after an integer number of
+                           samples smaller than MaxPeriod the blocks are
+                           views of a cached table, if not they are computed
+        '''
+        self.Fc = Fc
+        self.Fs = Fs
+        Frac = Fraction(Fc/Fs).limit_denominator(MaxPeriod)
+        if abs(float(Frac) - Fc/Fs) < 1e-12:
+            self.Period = Frac.denominator
+        else:
+            self.Period = None
+        self.SampInd = 0
+
+    def Block(self, nSamps):
+        '''Returns the next nSamps samples of the carrier, must not be
+           modified
+        '''
+        if self.Period is not None:
+            Phase = self.SampInd % self.Period
+            Table = GetCarrierTable(self.Fc, self.Fs, self.Period,
+                                    Phase + nSamps)
+            Carrier = Table[Phase:Phase + nSamps]
+        else:
+            n = self.SampInd + np.arange(nSamps)
+            Carrier = np.exp(-2j*np.pi*((self.Fc*n/self.Fs) % 1))
+        self.SampInd += nSamps
+        return Carrier
+
+    def Skip(self, nSamps):
+        '''Advances the phase over nSamps samples that were not acquired
+        '''
+        self.SampInd += nSamps
+
+    def Reset(self):
+        self.SampInd = 0
+
+
+class FIRDecimator():
+    def __init__(self, DownFact, Taps):
+        '''Polyphase FIR filter that only computes the samples kept after
+           the decimation. The input history and the decimation phase are
+           kept between blocks, at the head of a persistent buffer that
+           the caller can fill directly with GetInput.
+           DownFact: int. Decimation factor
+           Taps: array. FIR coefficients
+        '''
+        self.DownFact = DownFact
+        self.Taps = np.asarray(Taps, dtype=float)
+        self.nTaps = self.Taps.shape[0]
+        # Reversed taps padded to a multiple of DownFact, applied to the
+        # windows of the kept samples
+        self.nPoly = -(-self.nTaps//DownFact)
+        self.Poly = np.zeros(self.nPoly*DownFact)
+        self.Poly[:self.nTaps] = self.Taps[::-1]
+        self.Buf = None
+        self.Phase = 0
+
+    def GetInput(self, nSamps, nChannels, dtype=float):
+        '''Returns the (nSamps, nChannels) view of the buffer where the
+           next block goes, fill it and call Apply(nSamps=nSamps)
+        '''
+        dtype = np.result_type(dtype, self.Taps)
+        nHist = self.nTaps - 1
+        # Room for the padded windows of the last outputs
+        Size = nHist + nSamps + (self.nPoly + 1)*self.DownFact
+        if (self.Buf is None or self.Buf.shape[0] < Size or
+                self.Buf.shape[1] != nChannels or self.Buf.dtype != dtype):
+            Buf = np.zeros((Size, nChannels), dtype=dtype)
+            if self.Buf is not None and self.Buf.shape[1] == nChannels:
+                Buf[:nHist] = self.Buf[:nHist]
+            self.Buf = Buf
+        return self.Buf[nHist:nHist + nSamps]
+
+    def Apply(self, Sig=None, nSamps=None):
+        '''Filters and decimates Sig (nSamps, ...), or the nSamps samples
+           already written in the view given by GetInput if Sig is None
+        '''
+        if Sig is not None:
+            nSamps = Sig.shape[0]
+            Shape = Sig.shape[1:]
+            if nSamps == 0:
+                # Empty output of a previous stage
+                return np.zeros((0, ) + Shape,
+                                dtype=np.result_type(Sig.dtype, self.Taps))
+            Sig = Sig.reshape((nSamps, -1))
+            self.GetInput(nSamps, Sig.shape[1], Sig.dtype)[:] = Sig
+        else:
+            Shape = self.Buf.shape[1:]
+        Buf = self.Buf
+        nBuf = self.nTaps - 1 + nSamps
+
+        # Output m is the window that starts at Buf index Phase + m*DownFact
+        nOut = len(range(self.Phase, nSamps, self.DownFact))
+        L = self.Poly.shape[0]
+        # The padding after the block has zero weight, keep it finite
+        Buf[nBuf:self.Phase + (nOut - 1)*self.DownFact + L] = 0
+
+        if np.iscomplexobj(Buf):
+            Data = Buf.view(float)
+        else:
+            Data = Buf
+        Wind = np.lib.stride_tricks.sliding_window_view(Data, L, axis=0)
+        Wind = Wind[self.Phase:self.Phase + nOut*self.DownFact:
+                    self.DownFact]
+        Out = np.einsum('k,mck->mc', self.Poly, Wind)
+        if np.iscomplexobj(Buf):
+            Out = Out.view(complex)
+
+        self.Phase = (self.Phase - nSamps) % self.DownFact
+        # The history of the next block goes to the head of the buffer
+        Buf[:self.nTaps - 1] = Buf[nBuf - self.nTaps + 1:nBuf].copy()
+        return Out.reshape((nOut, ) + Shape)
+
+    def Skip(self, nSamps):
+        '''Advances the decimation phase over nSamps missing samples.
+           Returns the number of outputs skipped
+        '''
+        nOut = len(range(self.Phase, nSamps, self.DownFact))
+        self.Phase = (self.Phase - nSamps) % self.DownFact
+        return nOut
+
+
+def GetDecimStages(DownFact, MaxStageFact=10):
+    '''Splits a decimation factor in a list of stage factors, each one as
+       close as possible to MaxStageFact
+       100 -> [10, 10]
+    '''
+    Primes = []
+    n = DownFact
+    p = 2
+    while p*p <= n:
+        while n % p == 0:
+            Primes.append(p)
+            n = n//p
+        p = p + 1
+    if n > 1:
+        Primes.append(n)
+
+    Stages = []
+    for p in sorted(Primes, reverse=True):
+        for i, st in enumerate(Stages):
+            if st*p <= MaxStageFact:
+                Stages[i] = st*p
+                break
+        else:
+            Stages.append(p)
+    return sorted(Stages, reverse=True)
+
+
+class MultiStageDecimator():
+    def __init__(self, Fs, DownFact, Atten=60):
+        '''Cascade of FIRDecimator stages chosen from DownFact. The last
+           stage cuts at FsOut/2, the previous ones only reject the bands
+           that alias into the output band.
+           Fs: float. Input Sampling Frequency
+           DownFact: int. Total decimation factor
+           Atten: float. Stop band attenuation in dB of the stages
+        '''
+        self.FsOut = Fs/DownFact
+        self.Stages = []
+        FsIn = Fs
+        Facts = GetDecimStages(DownFact)
+        for i, Fact in enumerate(Facts):
+            FsStage = FsIn/Fact
+            if i == len(Facts) - 1:
+                Width = self.FsOut/2
+                Cutoff = self.FsOut/2
+            else:
+                Width = FsStage - self.FsOut
+                Cutoff = FsStage/2
+            nTaps, beta = signal.kaiserord(Atten, Width/(0.5*FsIn))
+            nTaps = max(nTaps, 2*Fact + 1)
+            Taps = signal.firwin(nTaps, Cutoff,
+                                 window=('kaiser', beta),
+                                 fs=FsIn)
+            self.Stages.append(FIRDecimator(Fact, Taps))
+            FsIn = FsStage
+
+    def GetInput(self, nSamps, nChannels, dtype=float):
+        '''Input view of the first stage, see FIRDecimator.GetInput
+        '''
+        return self.Stages[0].GetInput(nSamps, nChannels, dtype)
+
+    def Apply(self, Sig=None, nSamps=None):
+        Sig = self.Stages[0].Apply(Sig, nSamps)
+        for Stage in self.Stages[1:]:
+            Sig = Stage.Apply(Sig)
+        return Sig
+
+    def Skip(self, nSamps):
+        for Stage in self.Stages:
+            nSamps = Stage.Skip(nSamps)
+
+
 class Demod():
-    def __init__(self, Fc, FetchSize, Fs, DownFact, Order, Signal):
+    def __init__(self, Fc, FetchSize, Fs, DownFact, Order, Signal,
+                 DecimMode='IIR'):
         ''' Demodulation Class, applies the filters and the resampling process.
             Fc: float. Frequency of the Carrier used for Modulation
             FetchSize: int. Defines the number of samples of the buffer of
@@ -145,26 +409,47 @@ class Demod():
                            Frequency of the demodulation process
             Order: int. Order of the internal filter of the process
             Signal: array. Contains the values that forms the carrier signal
-                           used in Modulation
+                           used in Modulation. If None the carrier is
+                           generated with a NCO at Fc
+            DecimMode: str. 'IIR' filters at full rate and keeps one of
+                            every DownFact samples. 'MultiStage' uses a
+                            MultiStageDecimator that only computes the kept
+                            samples, Order is not used
         '''
         self.Fs = Fs
         self.Fc = Fc
         self.DownFact = DownFact
         self.FsOut = Fs/DownFact
+        self.DecimMode = DecimMode
 
-        self.FiltR = Filter(Fs, self.FsOut/2, 'lp', Order)
-        self.FiltI = Filter(Fs, self.FsOut/2, 'lp', Order)
+        if DecimMode == 'MultiStage':
+            self.Decim = MultiStageDecimator(Fs, DownFact)
+        else:
+            self.FiltR = Filter(Fs, self.FsOut/2, 'lp', Order)
+            self.FiltI = Filter(Fs, self.FsOut/2, 'lp', Order)
 
         self.vcoi = Signal
+        if Signal is None:
+            self.NCO = NCO(Fc, Fs)
+        # Index of the next block where the first kept sample is
+        self.DecimPhase = 0
 
     def Apply(self, SigIn):
-        rdem = np.real(self.vcoi*SigIn)
-        idem = np.imag(self.vcoi*SigIn)
+        vcoi = self.vcoi
+        if vcoi is None:
+            vcoi = self.NCO.Block(SigIn.shape[0])
+
+        if self.DecimMode == 'MultiStage':
+            return self.Decim.Apply(vcoi*SigIn)
+
+        rdem = np.real(vcoi*SigIn)
+        idem = np.imag(vcoi*SigIn)
 
         FilterRPart = self.FiltR.Apply(rdem)
         FilterIPart = self.FiltI.Apply(idem)
 
-        sObject = slice(None, None, self.DownFact)
+        sObject = slice(self.DecimPhase, None, self.DownFact)
+        self.DecimPhase = (self.DecimPhase - SigIn.shape[0]) % self.DownFact
 
         RSrdem = FilterRPart[sObject]
         RSidem = FilterIPart[sObject]
@@ -173,12 +458,366 @@ class Demod():
 
         return complexDem
 
+    def Skip(self, nSamps):
+        '''Keeps the carrier phase and the decimation in step with the
+           acquisition when nSamps samples were lost, the filter states
+           are kept
+        '''
+        if self.vcoi is None:
+            self.NCO.Skip(nSamps)
+        if self.DecimMode == 'MultiStage':
+            self.Decim.Skip(nSamps)
+        else:
+            self.DecimPhase = (self.DecimPhase - nSamps) % self.DownFact
+
+
+class DemodBatch():
+    def __init__(self, nCols, nRows, Fs, DownFact, Order, Signal,
+                 DecimMode='IIR', Fcs=None):
+        ''' Demodulation of all the rows against all the carriers at once.
+            Gives the same result than one Demod instance per channel.
+            nCols: int. Number of carriers (columns)
+            nRows: int. Number of acquired rows
+            Fs: float. Sampling Frequency used for acquisition process
+            DownFact: int. Down Sampling Factor to calculate Sampling
+                           Frequency of the demodulation process
+            Order: int. Order of the internal filter of the process
+            Signal: array. Contains the values that forms the carrier signal
+                           used in Modulation, (FetchSize, ) shared by all
+                           the columns or (FetchSize, nCols). If None the
+                           carriers are generated with a NCO per column
+            DecimMode: str. 'IIR' or 'MultiStage', see Demod
+            Fcs: list. Carrier frequency of each column, needed when
+                       Signal is None
+        '''
+        self.Fs = Fs
+        self.nCols = nCols
+        self.nRows = nRows
+        self.DownFact = DownFact
+        self.FsOut = Fs/DownFact
+        self.DecimMode = DecimMode
+
+        if DecimMode == 'MultiStage':
+            self.Decim = MultiStageDecimator(Fs, DownFact)
+        else:
+            # The real and imaginary parts of each channel are filtered as
+            # contiguous rows, like the 1D signals of Demod
+            self.Filt = Filter(Fs, self.FsOut/2, 'lp', Order,
+                               nChannels=2*nRows*nCols, Axis=1)
+            self.Zi = self.Filt.zi.reshape((2, nRows, nCols, -1))
+        self.DecimPhase = 0
+        # Preallocated input and mixing buffers of the IIR mode
+        self.SigT = None
+        self.Mixed = None
+
+        self.NCOs = None
+        if Signal is None:
+            self.NCOs = [NCO(Fc, Fs) for Fc in Fcs]
+            ReserveCarrierTables(nCols)
+            self.Carriers = np.zeros((2, nCols, 0))
+        else:
+            Signal = np.asarray(Signal)
+            if Signal.ndim == 1:
+                Signal = np.broadcast_to(Signal[:, None],
+                                         (Signal.shape[0], nCols))
+            self.Carriers = np.ascontiguousarray(np.stack((Signal.real.T,
+                                                           Signal.imag.T)))
+
+    def GetCarriers(self, nSamps):
+        '''Returns the real and imaginary parts of the carriers of the next
+           nSamps samples, (2, nCols, nSamps) contiguous along the samples
+        '''
+        if self.NCOs is None:
+            return self.Carriers
+        if self.Carriers.shape[2] != nSamps:
+            self.Carriers = np.zeros((2, self.nCols, nSamps))
+        for ic, nco in enumerate(self.NCOs):
+            Carrier = nco.Block(nSamps)
+            self.Carriers[0, ic] = Carrier.real
+            self.Carriers[1, ic] = Carrier.imag
+        return self.Carriers
+
+    def Apply(self, SigIn, Out=None):
+        '''Demodulates a block of (nSamps, nRows) samples.
+           Returns (nOut, nRows*nCols) complex, ordered by row and then by
+           column as DemodParameters.GetChannels. nOut can differ by one
+           between blocks when DownFact does not divide nSamps
+           Out: array. Optional array where the result is written
+        '''
+        nSamps = SigIn.shape[0]
+        Carriers = self.GetCarriers(nSamps)
+        if self.DecimMode == 'MultiStage':
+            # Mixed straight into the input buffer of the decimator, by
+            # column and row so the inner loop runs over the rows
+            Mixed = self.Decim.GetInput(nSamps, self.nCols*self.nRows,
+                                        complex)
+            Mixed = Mixed.reshape((nSamps, self.nCols, self.nRows))
+            np.multiply(SigIn[:, None, :], Carriers[0].T[:, :, None],
+                        out=Mixed.real)
+            np.multiply(SigIn[:, None, :], Carriers[1].T[:, :, None],
+                        out=Mixed.imag)
+            Dem = self.Decim.Apply(nSamps=nSamps)
+            Dem = Dem.reshape((-1, self.nCols, self.nRows))
+            Dem = Dem.transpose((0, 2, 1)).reshape((-1, self.nRows *
+                                                    self.nCols))
+        else:
+            Dem = self._ApplyIIR(SigIn, Carriers)
+        if Out is None:
+            return Dem
+        Out[:Dem.shape[0], :] = Dem
+        return Out[:Dem.shape[0], :]
+
+    def _ApplyIIR(self, SigIn, Carriers):
+        '''Mixes and filters the channels by tiles of columns of about
+           DemodTileBytes, so the mixed signals are filtered from the cache
+        '''
+        nSamps = SigIn.shape[0]
+        if self.SigT is None or self.SigT.shape[1] != nSamps:
+            TileCols = max(1, min(self.nCols,
+                                  DemodTileBytes//(16*max(nSamps, 1))))
+            self.SigT = np.empty((self.nRows, nSamps))
+            self.Mixed = np.empty((2, TileCols, nSamps))
+        np.copyto(self.SigT, SigIn.T)
+        TileCols = self.Mixed.shape[1]
+        nOut = len(range(self.DecimPhase, nSamps, self.DownFact))
+        Dem = np.empty((nOut, self.nRows, self.nCols), dtype=complex)
+        for ir in range(self.nRows):
+            for c0 in range(0, self.nCols, TileCols):
+                Cols = slice(c0, min(c0 + TileCols, self.nCols))
+                Mixed = self.Mixed[:, :Cols.stop - c0]
+                np.multiply(self.SigT[ir], Carriers[:, Cols], out=Mixed)
+                Filtered, self.Zi[:, ir, Cols] = signal.lfilter(
+                    self.Filt.b, self.Filt.a, Mixed, axis=-1,
+                    zi=self.Zi[:, ir, Cols])
+                Filtered = Filtered[:, :, self.DecimPhase::self.DownFact]
+                Dem[:, ir, Cols].real = Filtered[0].T
+                Dem[:, ir, Cols].imag = Filtered[1].T
+        self.DecimPhase = (self.DecimPhase - nSamps) % self.DownFact
+        return Dem.reshape((nOut, self.nRows*self.nCols))
+
+    def Skip(self, nSamps):
+        '''See Demod.Skip
+        '''
+        if self.NCOs is not None:
+            for nco in self.NCOs:
+                nco.Skip(nSamps)
+        if self.DecimMode == 'MultiStage':
+            self.Decim.Skip(nSamps)
+        else:
+            self.DecimPhase = (self.DecimPhase - nSamps) % self.DownFact
+
+
+def GetChannelizerSize(Fcs, Fs, MaxSize=8192):
+    '''Returns the smallest number of bins M so that all the carriers lie
+       on the Fs/M grid, and the bin index of each carrier
+    '''
+    Fracs = [Fraction(Fc/Fs).limit_denominator(MaxSize) for Fc in Fcs]
+    M = 1
+    for fr in Fracs:
+        M = M*fr.denominator//int(np.gcd(M, fr.denominator))
+    if M > MaxSize:
+        raise ValueError('Carriers {} need more than {} bins'.format(Fcs,
+                                                                   MaxSize))
+    Bins = []
+    for Fc, fr in zip(Fcs, Fracs):
+        if abs(float(fr) - Fc/Fs) > 1e-9 or float(fr) > 0.5:
+            raise ValueError('Carrier {} not on the Fs/{} grid'.format(Fc, M))
+        Bins.append(int(fr*M))
+    return M, Bins
+
+
+class Channelizer():
+    def __init__(self, Fcs, nRows, Fs, DownFact, Atten=60):
+        ''' Polyphase DFT filter bank that demodulates all the carriers of
+            each row in one pass. Each output is the low pass filtered signal
+            mixed with exp(-j*2*pi*Fc*t), t counted from the first sample,
+            only computed for the samples kept after the decimation.
+            Fcs: list. Carrier frequencies, must be multiples of Fs/M
+            nRows: int. Number of acquired rows
+            Fs: float. Sampling Frequency used for acquisition process
+            DownFact: int. Down Sampling Factor
+            Atten: float. Stop band attenuation of the prototype filter in dB
+        '''
+        self.Fs = Fs
+        self.nRows = nRows
+        self.nCols = len(Fcs)
+        self.DownFact = DownFact
+        self.FsOut = Fs/DownFact
+        self.M, self.Bins = GetChannelizerSize(Fcs, Fs)
+
+        nTaps, beta = signal.kaiserord(Atten, (self.FsOut/2)/(0.5*Fs))
+        self.nPoly = -(-nTaps//self.M)
+        self.L = self.nPoly*self.M
+        Taps = signal.firwin(self.L, self.FsOut/2,
+                             window=('kaiser', beta),
+                             fs=Fs)
+        self.PolyTaps = Taps[::-1].reshape((self.nPoly, self.M))
+
+        Bins = np.array(self.Bins)
+        self.DFT = np.exp(-2j*np.pi*np.outer(np.arange(self.M), Bins)/self.M)
+        self.UseFFT = self.nCols > np.log2(self.M)
+
+        self.Hist = np.zeros((self.L - 1, nRows))
+        self.Phase = 0
+        self.SampInd = 0
+
+    def Apply(self, SigIn):
+        '''Demodulates a block of (nSamps, nRows) samples.
+           Returns (nOut, nRows*nCols) complex ordered by row and column
+        '''
+        nSamps = SigIn.shape[0]
+        nOut = len(range(self.Phase, nSamps, self.DownFact))
+        Buf = np.concatenate((self.Hist, SigIn), axis=0)
+
+        Out = np.zeros((nOut, self.nRows, self.nCols), dtype=complex)
+        if nOut:
+            Wind = np.lib.stride_tricks.sliding_window_view(Buf, self.M,
+                                                            axis=0)
+            # Fold the windows of L samples into M bins
+            Folded = np.zeros((nOut, self.nRows, self.M))
+            for p in range(self.nPoly):
+                start = self.Phase + p*self.M
+                Segs = Wind[start:start + (nOut - 1)*self.DownFact + 1:
+                            self.DownFact]
+                Folded += Segs*self.PolyTaps[p]
+            if self.UseFFT:
+                Out[:] = np.fft.rfft(Folded, axis=2)[:, :, self.Bins]
+            else:
+                Out[:] = Folded @ self.DFT
+            # Carrier phase referred to the newest sample of each window
+            n = self.SampInd + self.Phase + np.arange(nOut)*self.DownFact
+            Rot = np.exp(-2j*np.pi*np.outer((n + 1) % self.M,
+                                            self.Bins)/self.M)
+            Out *= Rot[:, None, :]
+
+        self.Phase = (self.Phase - nSamps) % self.DownFact
+        self.SampInd += nSamps
+        self.Hist = Buf[Buf.shape[0] - self.L + 1:]
+        return Out.reshape((nOut, self.nRows*self.nCols))
+
+    def Skip(self, nSamps):
+        '''See Demod.Skip
+        '''
+        self.Phase = (self.Phase - nSamps) % self.DownFact
+        self.SampInd += nSamps
+
+
+def GenDemodEngine(Engine, Fcs, nRows, Fs, DownFact, Order, Signal,
+                   DecimMode='IIR'):
+    '''Returns the demodulation engine used by DemodThread
+       Engine: str. 'Mixer' or 'Channelizer'
+       Fcs: list. Carrier frequency of each column
+    '''
+    if Engine == 'Channelizer':
+        return Channelizer(Fcs=Fcs,
+                           nRows=nRows,
+                           Fs=Fs,
+                           DownFact=DownFact)
+    return DemodBatch(nCols=len(Fcs),
+                      nRows=nRows,
+                      Fs=Fs,
+                      DownFact=DownFact,
+                      Order=Order,
+                      Signal=Signal,
+                      DecimMode=DecimMode,
+                      Fcs=Fcs)
+
+
+def _DemodWorker(Conn, InName, OutName, InShape, OutShape, Rows, nCols,
+                 EngineKwargs):
+    InShm = shared_memory.SharedMemory(name=InName)
+    OutShm = shared_memory.SharedMemory(name=OutName)
+    InData = np.ndarray(InShape, dtype=float, buffer=InShm.buf)
+    OutData = np.ndarray(OutShape, dtype=complex, buffer=OutShm.buf)
+    Dem = GenDemodEngine(nRows=Rows[1] - Rows[0], **EngineKwargs)
+    OutCols = slice(Rows[0]*nCols, Rows[1]*nCols)
+    while True:
+        nSamps = Conn.recv()
+        if nSamps is None:
+            break
+        if isinstance(nSamps, tuple):
+            # ('Skip', nSamps)
+            Dem.Skip(nSamps[1])
+            continue
+        Res = Dem.Apply(InData[:nSamps, Rows[0]:Rows[1]])
+        OutData[:Res.shape[0], OutCols] = Res
+        Conn.send(Res.shape[0])
+    del InData, OutData
+    InShm.close()
+    OutShm.close()
+
+
+class DemodPool():
+    def __init__(self, nProcs, nRows, FetchSize, **EngineKwargs):
+        '''Demodulation engine that splits the rows between worker
+           processes. Blocks and results are exchanged through shared
+           memory, each worker keeps the filter state of its rows.
+           nProcs: int. Number of worker processes
+           nRows: int. Number of acquired rows
+           FetchSize: int. Maximum number of samples of the input blocks
+           EngineKwargs: arguments of GenDemodEngine for the workers
+        '''
+        nCols = len(EngineKwargs['Fcs'])
+        MaxOut = FetchSize//EngineKwargs['DownFact'] + 1
+        InShape = (FetchSize, nRows)
+        OutShape = (MaxOut, nRows*nCols)
+        self.InShm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(InShape))*8)
+        self.OutShm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(OutShape))*16)
+        self.InData = np.ndarray(InShape, dtype=float, buffer=self.InShm.buf)
+        self.OutData = np.ndarray(OutShape, dtype=complex,
+                                  buffer=self.OutShm.buf)
+
+        Ctx = multiprocessing.get_context('spawn')
+        self.Conns = []
+        self.Procs = []
+        Bounds = np.linspace(0, nRows, min(nProcs, nRows) + 1).astype(int)
+        for start, stop in zip(Bounds[:-1], Bounds[1:]):
+            Conn, ChildConn = Ctx.Pipe()
+            Proc = Ctx.Process(target=_DemodWorker,
+                               args=(ChildConn, self.InShm.name,
+                                     self.OutShm.name, InShape, OutShape,
+                                     (start, stop), nCols, EngineKwargs),
+                               daemon=True)
+            Proc.start()
+            self.Conns.append(Conn)
+            self.Procs.append(Proc)
+
+    def Apply(self, SigIn):
+        '''Demodulates a block in the workers, returns a view of the shared
+           output valid until the next call
+        '''
+        nSamps = SigIn.shape[0]
+        self.InData[:nSamps, :] = SigIn
+        for Conn in self.Conns:
+            Conn.send(nSamps)
+        nOut = [Conn.recv() for Conn in self.Conns][0]
+        return self.OutData[:nOut, :]
+
+    def Skip(self, nSamps):
+        for Conn in self.Conns:
+            Conn.send(('Skip', nSamps))
+
+    def Close(self):
+        for Conn in self.Conns:
+            Conn.send(None)
+        for Proc in self.Procs:
+            Proc.join()
+        del self.InData, self.OutData
+        for Shm in (self.InShm, self.OutShm):
+            Shm.close()
+            Shm.unlink()
+
 
 class DemodThread(Qt.QThread):
-    NewData = Qt.pyqtSignal()
+    NewData = Qt.pyqtSignal(object)
 
     def __init__(self, Fcs, RowList, FetchSize, FsDemod, DSFact,
-                 FiltOrder, Signal, Gain, **Keywards):
+                 FiltOrder, Signal, Gain, DecimMode='IIR', Engine='Mixer',
+                 nProcs=0, QueueDepth=8, QueuePolicy='drop-oldest',
+                 ScalingCoeffs=None, OutPoolSize=32, PoolSize=None,
+                 **Keywards):
         '''Initialization of Demodulation Process Thread
            Fcs: dictionary. returns the name of the columns with its carrier
                             frequency
@@ -187,6 +826,7 @@ class DemodThread(Qt.QThread):
                            acquired
                            ['Ch04', 'Ch05', 'Ch06']
            FetchSize: int. Defines the number of samples to fill the buffer.
+                           DSFact does not need to divide it
            FsDemod: float. Specifies the Sampling Frequency of the Acquisition
                            process
            DSFacti: int. Specifies de DownSampling Factor to reduce sampling
@@ -194,52 +834,140 @@ class DemodThread(Qt.QThread):
            FiltOrder: int. Defines the order of the internal filter of the
                            demodulation process
            Signal: array. Contains the values that forms the carrier signal
-                          used in Modulation process
+                          used in Modulation process. If None phase
+                          continuous carriers are generated at Fcs
+           DecimMode: str. 'IIR' or 'MultiStage', see Demod
+           Engine: str. 'Mixer' uses DemodBatch. 'Channelizer' extracts all
+                        the carriers of a row in one pass, the carriers are
+                        generated internally so Signal, FiltOrder and
+                        DecimMode are not used
+           nProcs: int. If > 0 the rows are demodulated in nProcs worker
+                        processes with DemodPool
+           QueueDepth: int. Number of blocks that can wait to be demodulated
+           QueuePolicy: str. Overflow policy of the input queue, 'block',
+                             'drop-oldest' or 'drop-newest'
+           ScalingCoeffs: array. If given the blocks are raw int16 codes,
+                                 scaled to volts in this thread
+           OutPoolSize: int. Number of output buffers. Each demodulated
+                             block is emitted with NewData in its own
+                             buffer, valid for the next OutPoolSize blocks,
+                             see BlockModule.IsOverrun
+           PoolSize: int. PoolSize of ReadAnalog.ReadContData, QueueDepth
+                          must be smaller so the queued blocks are not
+                          overwritten. The overwritten blocks are skipped
+                          and counted as gaps
            Keywords: dictionary. Contains the output Type of demodulation,
                                  absolut, real, imaginary or angle
                                  {'OutType': 'Abs'}
         '''
         super(DemodThread, self).__init__()
-        self.ToDemData = None
+        if PoolSize is not None and QueueDepth >= PoolSize:
+            raise ValueError('QueueDepth {} must be smaller than the '
+                             'PoolSize {}'.format(QueueDepth, PoolSize))
+        self.Queue = BlockQueue(Depth=QueueDepth,
+                                Policy=QueuePolicy,
+                                Name='Demod')
+        self.Metrics = StageMetrics('Demod', self.Queue)
+        self.Profiler = ThreadProfiler('Demod', Wake=self.Queue.Wake)
+        self.Running = True
 
         self.Gain = Gain
-        self.DemOutputs = []
         self.NamesForDict = []
         for Row in RowList:
-            DemOut = []
             for Cols, Freq in Fcs.items():
-                Dem = Demod(Freq, FetchSize, FsDemod, DSFact,
-                            FiltOrder, Signal)
-                DemOut.append(Dem)
                 self.NamesForDict.append(str(Row+Cols))
-            self.DemOutputs.append(DemOut)
-        self.OutDemodData = np.ndarray((round(FetchSize/DSFact),
-                                        round(len(RowList)*len(Fcs.keys()))),
-                                        dtype=complex)
+        EngineKwargs = {'Engine': Engine,
+                        'Fcs': list(Fcs.values()),
+                        'Fs': FsDemod,
+                        'DownFact': DSFact,
+                        'Order': FiltOrder,
+                        'Signal': Signal,
+                        'DecimMode': DecimMode}
+        if nProcs > 0:
+            self.Demod = DemodPool(nProcs=nProcs,
+                                   nRows=len(RowList),
+                                   FetchSize=FetchSize,
+                                   **EngineKwargs)
+        else:
+            self.Demod = GenDemodEngine(nRows=len(RowList), **EngineKwargs)
+        # DSFact does not need to divide the block size, the output blocks
+        # are views of the rows of the pool buffers
+        self.OutPoolSize = OutPoolSize
+        self.OutPool = BlockPool(OutPoolSize,
+                                 (FetchSize//DSFact + 1,
+                                  len(RowList)*len(Fcs.keys())),
+                                 dtype=complex)
+        self.OutDemodData = self.OutPool.Buffers[0, :0, :]
+        # Sample indexes of the demodulated output, resynchronized with
+        # the StartInd of the input DataBlocks after a gap
+        self.DSFact = DSFact
+        self.InInd = None
+        self.OutInd = 0
+        self.ScalingCoeffs = ScalingCoeffs
+        self.ScaleBuffer = None
 
     def run(self):
-        while True:
-            if self.ToDemData is not None:
-                ind = 0
-                for ir, rows in enumerate(self.DemOutputs):
-                    for instance in rows:
-                        data = instance.Apply(self.ToDemData[:, ir])
-                        #factor 2 a causa de la demodulación ya que el resultado
-                        #es (1/2)*Vin*Vcoi y dividido por la ganancia para tener
-                        #corriente
-                        self.OutDemodData[:, ind] = 2*data/self.Gain
-                        ind = ind + 1
-
-                self.NewData.emit()
-                self.ToDemData = None
-            else:
-                Qt.QThread.msleep(10)
-#        #multiprocessing
+        while self.Running:
+            self.Profiler.Check()
+            Block = self.Queue.Get(Wait=True,
+                                   Timeout=self.Profiler.GetTimeout())
+            if Block is not None and IsOverrun(Block):
+                # Skipped, the gap is resynchronized at the next block
+                self.Metrics.CheckBlock(Block)
+            elif Block is not None:
+                self.Metrics.StartBlock()
+                # The kernels work on plain arrays
+                ToDemData = np.asarray(Block)
+                if self.ScalingCoeffs is not None:
+                    ToDemData = self._Scale(ToDemData)
+                self._CheckGap(Block)
+                Dem = self.Demod.Apply(ToDemData)
+                if Dem.shape[0] > self.OutPool.Buffers.shape[1]:
+                    self.OutPool = BlockPool(self.OutPoolSize, Dem.shape,
+                                             dtype=complex)
+                self.OutDemodData = self.OutPool.Next(
+                    nSamps=Dem.shape[0],
+                    StartInd=self.OutInd,
+                    AcqTime=getattr(Block, 'AcqTime', None),
+                    SeqNum=getattr(Block, 'SeqNum', None))
+                self.OutDemodData[:, :] = Dem
+                self.OutInd += Dem.shape[0]
+                #factor 2 a causa de la demodulación ya que el resultado
+                #es (1/2)*Vin*Vcoi y dividido por la ganancia para tener
+                #corriente
+                self.OutDemodData *= 2
+                self.OutDemodData /= self.Gain
+                self.Metrics.EndBlock(Block.shape[0], Block=Block)
+                self.NewData.emit(self.OutDemodData)
+        self.Profiler.Stop()
+
+    def _CheckGap(self, Block):
+        '''Skips the samples lost before Block in the engine, so the
+           carrier phase follows the acquisition, and resynchronizes the
+           output sample index
+        '''
+        StartInd = getattr(Block, 'StartInd', None)
+        if StartInd is None:
+            return
+        if self.InInd is not None and StartInd != self.InInd:
+            if StartInd > self.InInd:
+                self.Demod.Skip(StartInd - self.InInd)
+            self.OutInd = -(-StartInd//self.DSFact)
+        self.InInd = StartInd + Block.shape[0]
+
+    def _Scale(self, Block):
+        if (self.ScaleBuffer is None or
+                self.ScaleBuffer.shape[0] < Block.shape[0]):
+            self.ScaleBuffer = np.empty(Block.shape)
+        return ScaleRaw(Block, self.ScalingCoeffs,
+                        Out=self.ScaleBuffer[:Block.shape[0], :])
 
     def AddData(self, NewData):
-        if self.ToDemData is not None:
-            print('Error Demod !!!!')
-        self.ToDemData = NewData
+        self.Queue.Put(NewData)
 
     def stop(self):
-        self.terminate()
+        self.Running = False
+        self.Queue.Close()
+        self.wait()
+        if isinstance(self.Demod, DemodPool):
+            self.Demod.Close()
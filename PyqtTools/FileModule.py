@@ -11,8 +11,21 @@ from PyQt5.QtWidgets import QFileDialog
 import h5py
 from PyQt5 import Qt
 import os
+import time
+import zlib
 import pickle
+import numpy as np
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from PyqtTools.BlockModule import BlockQueue, IsOverrun
+from PyqtTools.MetricsModule import StageMetrics
+from PyqtTools.ProfilerModule import ThreadProfiler
+from PyqtTools.RawFileModule import RawFileBuffer, LoadRaw
+
+
+log = logging.getLogger(__name__)
 
 SaveFilePars = [{'name': 'Save File',
                  'type': 'action'},
@@ -25,7 +38,43 @@ SaveFilePars = [{'name': 'Save File',
                  'suffix': 'B',
                  'limits': (1e6, 1e12),
                  'step': 100e6,
-                 'value': 50e6}
+                 'value': 50e6},
+                {'name': 'MaxTime',
+                 'title': 'MaxTime (0 Off)',
+                 'type': 'float',
+                 'siPrefix': True,
+                 'suffix': 's',
+                 'limits': (0, 1e6),
+                 'step': 60,
+                 'value': 0},
+                {'name': 'Backend',
+                 'type': 'list',
+                 'values': ['h5', 'raw'],
+                 'value': 'h5',
+                 'tip': 'raw ignores MaxSize, MaxTime, Compression, '
+                        'Overview and Swmr'},
+                {'name': 'Compression',
+                 'type': 'list',
+                 'values': ['none', 'lzf', 'gzip', 'shuffle+lzf',
+                            'shuffle+gzip'],
+                 'value': 'gzip'},
+                {'name': 'GzipLevel',
+                 'type': 'int',
+                 'limits': (0, 9),
+                 'value': 4},
+                {'name': 'CompressThreads',
+                 'title': 'Compression Threads',
+                 'type': 'int',
+                 'limits': (0, 64),
+                 'value': 0},
+                {'name': 'Overview',
+                 'title': 'Save Overview',
+                 'type': 'bool',
+                 'value': False},
+                {'name': 'Swmr',
+                 'title': 'Live Readable (SWMR)',
+                 'type': 'bool',
+                 'value': False},
                 ]
 
 
@@ -50,66 +99,595 @@ class SaveFileParameters(pTypes.GroupParameter):
     def FilePath(self):
         return self.param('File Path').value()
 
+    def GetParams(self):
+        '''Returns the saving arguments of DataSavingThread
+           {'MaxSize': 50000000,
+            'MaxTime': 0,
+            'Backend': 'h5',
+            'Compression': 'gzip',
+            'GzipLevel': 4,
+            'CompressThreads': 0,
+            'Overview': False,
+            'Swmr': False}
+        '''
+        SaveKwargs = {}
+        for p in self.children():
+            if p.name() in ('Save File', 'File Path'):
+                continue
+            SaveKwargs[p.name()] = p.value()
+        return SaveKwargs
+
+
+def GetCompressionKwargs(Compression, GzipLevel=4):
+    '''Returns the h5py create_dataset arguments of a codec
+       Compression: str. 'none', 'lzf', 'gzip', 'shuffle+lzf' or
+                         'shuffle+gzip'
+    '''
+    Kwargs = {}
+    Codec = Compression
+    if Compression.startswith('shuffle+'):
+        Kwargs['shuffle'] = True
+        Codec = Compression.split('+')[1]
+    if Codec == 'gzip':
+        Kwargs['compression'] = 'gzip'
+        Kwargs['compression_opts'] = GzipLevel
+    elif Codec == 'lzf':
+        Kwargs['compression'] = 'lzf'
+    elif Codec != 'none':
+        raise ValueError('Unknown compression {}'.format(Compression))
+    return Kwargs
+
+
+def FinalizeFile(h5File, Dset, nSamps, Pending=(), ValidDset=None):
+    '''Writes the pending compressed chunks, trims the preallocated rows of
+       the dataset and closes the file. Runs in the FileBuffer finalizer
+       thread
+    '''
+    if Dset is not None:
+        for Row, Fut in Pending:
+            Dset.id.write_direct_chunk((Row, 0), Fut.result())
+        Dset.resize((nSamps, Dset.shape[1]))
+    if ValidDset is not None:
+        ValidDset[:] = (nSamps, 1)
+    h5File.flush()
+    h5File.close()
+
+
+def CompressChunk(Chunk, Shuffle, GzipLevel):
+    '''Applies the HDF5 shuffle and deflate filters to a chunk, zlib
+       releases the GIL so it can run in a thread pool
+    '''
+    if Shuffle:
+        Bytes = Chunk.view(np.uint8).reshape((-1, Chunk.dtype.itemsize))
+        Chunk = np.ascontiguousarray(Bytes.T)
+    return zlib.compress(Chunk.tobytes(), GzipLevel)
+
+
+def ReduceBins(Min, Max, Sum, Cnt, Factor):
+    '''Merges groups of Factor consecutive bins (rows), the remaining rows
+       that do not fill a group are not used
+    '''
+    n = (Min.shape[0]//Factor)*Factor
+    Shape = (n//Factor, Factor, Min.shape[1])
+    return (Min[:n].reshape(Shape).min(axis=1),
+            Max[:n].reshape(Shape).max(axis=1),
+            Sum[:n].reshape(Shape).sum(axis=1, dtype=np.float64),
+            Cnt[:n].reshape((n//Factor, Factor)).sum(axis=1))
+
+
+class OverviewPyramid():
+    def __init__(self, h5File, nChannels, Factor=16, nLevels=6,
+                 dtype='f4'):
+        '''Min, max and mean of the data at several resolutions. The level
+           k is the dataset 'overview/L{k}' (bins, 3, nChannels) with
+           the min, max and mean of Factor**(k+1) samples per bin, given
+           by its attribute 'Factor'. Updated with each block, the last
+           incomplete bins are written by Close.
+           h5File: h5py.File. File where the datasets are created
+           nChannels: int. Number of channels
+           Factor: int. Samples of a level merged in each bin of the next
+           nLevels: int. Number of levels
+           dtype: str. Data type of the overview datasets
+        '''
+        self.Factor = Factor
+        self.nChannels = nChannels
+        Group = h5File.create_group('overview')
+        Group.attrs['Factor'] = Factor
+        self.Dsets = []
+        for lev in range(nLevels):
+            Dset = Group.create_dataset('L{}'.format(lev),
+                                        shape=(0, 3, nChannels),
+                                        maxshape=(None, 3, nChannels),
+                                        chunks=(256, 3, nChannels),
+                                        dtype=dtype)
+            Dset.attrs['Factor'] = Factor**(lev + 1)
+            self.Dsets.append(Dset)
+        # Bins of the level below not merged yet, (Min, Max, Sum, Cnt)
+        self.Rests = [None]*nLevels
+
+    def _Merge(self, lev, Bins):
+        Rest = self.Rests[lev]
+        if Rest is not None:
+            Bins = [np.concatenate((r, b)) for r, b in zip(Rest, Bins)]
+        nUsed = (Bins[0].shape[0]//self.Factor)*self.Factor
+        if nUsed < Bins[0].shape[0]:
+            # Copied, the blocks can be reused by the acquisition
+            self.Rests[lev] = [np.array(b[nUsed:]) for b in Bins]
+        else:
+            self.Rests[lev] = None
+        return ReduceBins(*Bins, Factor=self.Factor)
+
+    def _Write(self, lev, Bins):
+        Min, Max, Sum, Cnt = Bins
+        if Min.shape[0] == 0:
+            return
+        Dset = self.Dsets[lev]
+        ind = Dset.shape[0]
+        Dset.resize((ind + Min.shape[0], 3, self.nChannels))
+        Dset[ind:, 0, :] = Min
+        Dset[ind:, 1, :] = Max
+        Dset[ind:, 2, :] = Sum/Cnt[:, None]
+
+    def AddSample(self, Sample):
+        Bins = (Sample, Sample, Sample,
+                np.ones(Sample.shape[0], dtype=np.int64))
+        for lev in range(len(self.Dsets)):
+            Bins = self._Merge(lev, Bins)
+            if Bins[0].shape[0] == 0:
+                break
+            self._Write(lev, Bins)
+
+    def Close(self):
+        '''Writes the incomplete last bin of each level
+        '''
+        Bins = None
+        for lev, Rest in enumerate(self.Rests):
+            if Bins is not None and Rest is None:
+                Rest = Bins
+            elif Bins is not None:
+                Rest = [np.concatenate((r, b)) for r, b in zip(Rest, Bins)]
+            if Rest is None:
+                continue
+            Min, Max, Sum, Cnt = Rest
+            Bins = (Min.min(axis=0, keepdims=True),
+                    Max.max(axis=0, keepdims=True),
+                    Sum.sum(axis=0, keepdims=True, dtype=np.float64),
+                    Cnt.sum(keepdims=True))
+            self._Write(lev, Bins)
+            self.Rests[lev] = None
+
 
 class FileBuffer():
-    def __init__(self, FileName, MaxSize, nChannels):
+    def __init__(self, FileName, MaxSize, nChannels, dtype='f4',
+                 ChunkSize=None, GrowSize=None, FlushTime=1.0,
+                 FlushSize=64e6, Compression='gzip', GzipLevel=4,
+                 CompressThreads=0, MaxTime=None, MaxSamples=None, Fs=None,
+                 Overview=False, OverviewFactor=16, OverviewLevels=6,
+                 Swmr=False, ScalingCoeffs=None):
+        '''Saves the blocks in the dataset 'data' (samples, nChannels) of
+           h5 files. If MaxSize, MaxTime or MaxSamples is given, the
+           recording is split in parts FileName_0.h5, FileName_1.h5 ...
+           The next part is opened in advance and the finished ones are
+           closed in a background thread. Each part has the attributes
+           'StartSample' and 'StartTime' (epoch seconds) of its first sample.
+           FileName: str. Recording file name
+           MaxSize: int. Maximum size in bytes of each part
+           nChannels: int. Number of channels
+           dtype: str. Data type of the dataset
+           ChunkSize: int. Rows of the dataset chunks, if None it is a
+                           multiple of the first block size of about 1 MB,
+                           or 1/16 of MaxSize if smaller
+           GrowSize: int. Rows added to the dataset each time it is full,
+                          if None 16 chunks
+           FlushTime: float. Maximum time in seconds between flushes
+           FlushSize: float. Maximum bytes written between flushes
+           Compression: str. 'none', 'lzf', 'gzip', 'shuffle+lzf' or
+                             'shuffle+gzip'
+           GzipLevel: int. Compression level of gzip
+           CompressThreads: int. If > 0 the gzip codecs compress whole
+                                 chunks in a pool of threads and write them
+                                 with direct chunk writes
+           MaxTime: float. Maximum duration in seconds of each part
+           MaxSamples: int. Maximum number of samples of each part
+           Fs: float. Sampling Frequency, saved as attribute if given
+           Overview: bool. Saves in each part an OverviewPyramid of the data
+           OverviewFactor: int. Factor between the overview levels
+           OverviewLevels: int. Number of overview levels
+           Swmr: bool. Writes the parts in HDF5 single writer multiple
+                       reader mode, so they can be read while recording,
+                       see FileReaderModule.TailReader
+           The dataset 'nValid' of each part holds the number of samples
+           already written and 1 when the part is closed, it is updated at
+           each flush so the preallocated rows are not taken as samples
+           after a crash
+           ScalingCoeffs: array. (channels, coefficients) to convert raw
+                                 int16 codes to volts, saved as attribute
+                                 of each part, see BlockModule.ScaleRaw
+        '''
         self.FileBase = FileName.split('.h5')[0]
         self.PartCount = 0
         self.nChannels = nChannels
-        self.MaxSize = MaxSize
+        self.MaxSize = MaxSize or None
+        self.MaxTime = MaxTime or None
+        self.MaxSamples = MaxSamples or None
+        self.Split = (self.MaxSize is not None or
+                      self.MaxTime is not None or
+                      self.MaxSamples is not None)
+        self.Fs = Fs
+        self.TotalSamps = 0
+        # Growth of the files on disk, updated at each flush
+        self.BytesWritten = 0
+        self.dtype = np.dtype(dtype)
+        self.ChunkSize = ChunkSize
+        self.GrowSize = GrowSize
+        self.FlushTime = FlushTime
+        self.FlushSize = FlushSize
+        self.Compression = Compression
+        self.GzipLevel = GzipLevel
+        self.DsetKwargs = GetCompressionKwargs(Compression, GzipLevel)
+        self.Pool = None
+        if CompressThreads > 0:
+            if Compression in ('gzip', 'shuffle+gzip'):
+                self.Pool = ThreadPoolExecutor(CompressThreads)
+                self.MaxPending = 2*CompressThreads
+            else:
+                log.warning('Parallel compression only for gzip codecs')
+        self.Overview = Overview
+        self.OverviewFactor = OverviewFactor
+        self.OverviewLevels = OverviewLevels
+        self.Swmr = Swmr
+        self.ScalingCoeffs = ScalingCoeffs
+        self.SizeRatio = 1.0
+        self.Finalizer = ThreadPoolExecutor(1)
+        # (FileName, Future) of the parts handed to the finalizer
+        self.Closing = []
+        self.NextFile = None
+        self.h5File = None
         self._initFile()
 
-    def _initFile(self):
-        if self.MaxSize is not None:
-            FileName = '{}_{}.h5'.format(self.FileBase, self.PartCount)
+    def _OpenFile(self, PartCount):
+        if self.Split:
+            FileName = '{}_{}.h5'.format(self.FileBase, PartCount)
         else:
             FileName = self.FileBase + '.h5'
-        self.FileName = FileName
+        if self.Swmr:
+            return FileName, h5py.File(FileName, 'w', libver='latest')
+        return FileName, h5py.File(FileName, 'w')
+
+    def _initFile(self):
+        if self.NextFile is None:
+            self.FileName, self.h5File = self._OpenFile(self.PartCount)
+        else:
+            self.FileName, self.h5File = self.NextFile.result()
         self.PartCount += 1
-        self.h5File = h5py.File(FileName, 'w')
+        if self.Split:
+            self.NextFile = self.Finalizer.submit(self._OpenFile,
+                                                  self.PartCount)
+        self.Dset = None
+        self.ValidDset = None
+        self.Pyramid = None
+        self.nSamps = 0
+        # Chunks waiting to be compressed by the pool
+        self.Pending = deque()
+        self.ChunkBuf = None
+        self.ChunkInd = 0
+        self.nChunks = 0
+        # The file size is only read from disk at each flush, in between it
+        # is estimated with the compression ratio of the last flush
+        self.FileSize = 0
+        self.BytesSinceStat = 0
+        self.BytesSinceFlush = 0
+        self.LastFlush = time.time()
+        self.PartStart = time.time()
+
+    def _initDset(self, BlockSize):
+        SampBytes = self.nChannels*self.dtype.itemsize
+        if self.ChunkSize is None:
+            # The file grows by whole chunks
+            ChunkBytes = 2**20
+            if self.MaxSize is not None:
+                ChunkBytes = min(ChunkBytes, self.MaxSize/16)
+            nBlocks = int(round(ChunkBytes/(SampBytes*BlockSize)))
+            if nBlocks > 0:
+                self.ChunkSize = BlockSize*nBlocks
+            else:
+                self.ChunkSize = max(1, int(ChunkBytes//SampBytes))
+        if self.GrowSize is None:
+            self.GrowSize = 16*self.ChunkSize
         self.Dset = self.h5File.create_dataset('data',
-                                               shape=(0, self.nChannels),
+                                               shape=(self.GrowSize,
+                                                      self.nChannels),
                                                maxshape=(None, self.nChannels),
-                                               compression="gzip")
+                                               chunks=(self.ChunkSize,
+                                                       self.nChannels),
+                                               dtype=self.dtype,
+                                               **self.DsetKwargs)
+        if self.Overview:
+            self.Pyramid = OverviewPyramid(self.h5File, self.nChannels,
+                                           Factor=self.OverviewFactor,
+                                           nLevels=self.OverviewLevels,
+                                           dtype=np.result_type(self.dtype,
+                                                                np.float32))
+        if self.Pool is not None:
+            self.ChunkBuf = np.zeros((self.ChunkSize, self.nChannels),
+                                     dtype=self.dtype)
+        self.PartStart = time.time()
+        self.h5File.attrs['StartSample'] = self.TotalSamps
+        self.h5File.attrs['StartTime'] = self.PartStart
+        if self.Fs is not None:
+            self.h5File.attrs['Fs'] = self.Fs
+        if self.ScalingCoeffs is not None:
+            self.h5File.attrs['ScalingCoeffs'] = self.ScalingCoeffs
+        # A dataset, attributes can not be written in SWMR mode
+        self.ValidDset = self.h5File.create_dataset('nValid',
+                                                    data=(0, 0),
+                                                    dtype='i8')
+        if self.Swmr:
+            self.h5File.swmr_mode = True
 
     def AddSample(self, Sample):
         nSamples = Sample.shape[0]
-        FileInd = self.Dset.shape[0]
-        self.Dset.resize((FileInd + nSamples, self.nChannels))
-        self.Dset[FileInd:, :] = Sample
-        self.h5File.flush()
+        if self.Dset is None:
+            self._initDset(nSamples)
+        FileInd = self.nSamps
+        if FileInd + nSamples > self.Dset.shape[0]:
+            Grow = -(-nSamples//self.GrowSize)*self.GrowSize
+            self.Dset.resize((self.Dset.shape[0] + Grow, self.nChannels))
+        if self.Pool is None:
+            self.Dset[FileInd:FileInd + nSamples, :] = Sample
+        else:
+            self._AddChunks(Sample)
+        if self.Pyramid is not None:
+            self.Pyramid.AddSample(Sample)
+        self.nSamps += nSamples
+        self.TotalSamps += nSamples
 
-        stat = os.stat(self.FileName)
-        if stat.st_size > self.MaxSize:
-#            print(stat.st_size, self.MaxSize)
+        nBytes = Sample.size*self.dtype.itemsize
+        self.BytesSinceStat += nBytes
+        self.BytesSinceFlush += nBytes
+        if (self.BytesSinceFlush >= self.FlushSize or
+                time.time() - self.LastFlush >= self.FlushTime):
+            self.Flush()
+
+        if self.Split and self._CheckRollover(nBytes):
+            self._CheckClosing(Wait=True)
+            self._CloseFile()
             self._initFile()
 
+    def _CheckRollover(self, nBytes):
+        '''True if the part is full or a next block of nBytes would exceed
+           MaxSize
+        '''
+        if self.MaxSamples is not None and self.nSamps >= self.MaxSamples:
+            return True
+        if (self.MaxTime is not None and
+                time.time() - self.PartStart >= self.MaxTime):
+            return True
+        if self.MaxSize is not None:
+            Bytes = self.BytesSinceStat + nBytes
+            return self.FileSize + Bytes*self.SizeRatio > self.MaxSize
+        return False
+
+    def _AddChunks(self, Sample):
+        ind = 0
+        while ind < Sample.shape[0]:
+            n = min(self.ChunkSize - self.ChunkInd, Sample.shape[0] - ind)
+            self.ChunkBuf[self.ChunkInd:self.ChunkInd + n] = Sample[ind:ind + n]
+            self.ChunkInd += n
+            ind += n
+            if self.ChunkInd == self.ChunkSize:
+                self._SubmitChunk()
+        self._WriteChunks(Wait=False)
+
+    def _SubmitChunk(self):
+        Fut = self.Pool.submit(CompressChunk, self.ChunkBuf.copy(),
+                               self.DsetKwargs.get('shuffle', False),
+                               self.GzipLevel)
+        self.Pending.append((self.nChunks*self.ChunkSize, Fut))
+        self.nChunks += 1
+        self.ChunkInd = 0
+
+    def _WriteChunks(self, Wait):
+        while self.Pending:
+            Row, Fut = self.Pending[0]
+            if not (Wait or Fut.done() or
+                    len(self.Pending) > self.MaxPending):
+                break
+            self.Dset.id.write_direct_chunk((Row, 0), Fut.result())
+            self.Pending.popleft()
+
+    def Flush(self):
+        if self.Pool is not None:
+            self._WriteChunks(Wait=True)
+        if self.ValidDset is not None:
+            nValid = self.nSamps
+            if self.Pool is not None:
+                nValid = min(nValid, self.nChunks*self.ChunkSize)
+            self.ValidDset[0] = nValid
+        self.h5File.flush()
+        self.BytesSinceFlush = 0
+        self.LastFlush = time.time()
+
+        if (self.NextFile is not None and self.NextFile.done() and
+                self.NextFile.exception() is not None):
+            log.error('Error opening the next part: %s',
+                      self.NextFile.exception())
+
+        Size = os.stat(self.FileName).st_size
+        if self.BytesSinceStat > 0 and Size > self.FileSize:
+            self.SizeRatio = (Size - self.FileSize)/self.BytesSinceStat
+        self.BytesWritten += max(0, Size - self.FileSize)
+        self.FileSize = Size
+        self.BytesSinceStat = 0
+
+    def _CloseFile(self):
+        '''Hands the current part to the finalizer thread
+        '''
+        if self.Pool is not None and self.Dset is not None:
+            if self.ChunkInd > 0:
+                # HDF5 stores whole chunks, the padding is trimmed later
+                self.ChunkBuf[self.ChunkInd:] = 0
+                self._SubmitChunk()
+        if self.Pyramid is not None:
+            self.Pyramid.Close()
+        Fut = self.Finalizer.submit(FinalizeFile, self.h5File, self.Dset,
+                                    self.nSamps, self.Pending,
+                                    self.ValidDset)
+        self.Closing.append((self.FileName, Fut))
+
+    def _CheckClosing(self, Wait=False):
+        '''Raises the first error of the parts finalized in the background,
+           all of them are logged
+           Wait: bool. Waits for the parts still being finalized
+        '''
+        Error = None
+        for FileName, Fut in list(self.Closing):
+            if not (Wait or Fut.done()):
+                continue
+            self.Closing.remove((FileName, Fut))
+            if Fut.exception() is not None:
+                log.error('Error finalizing %s: %s', FileName,
+                          Fut.exception())
+                Error = Error or Fut.exception()
+        if Error is not None:
+            raise Error
+
+    def Close(self):
+        '''Finalizes the current part, removes the parts without samples
+           opened in advance and waits for the background threads. Raises
+           the errors of the parts finalized in the background
+        '''
+        try:
+            if self.Dset is None and self.TotalSamps > 0:
+                self.h5File.close()
+                os.remove(self.FileName)
+            else:
+                self._CloseFile()
+            if self.NextFile is not None:
+                NextFile = self.NextFile
+                self.NextFile = None
+                FileName, h5File = NextFile.result()
+                h5File.close()
+                os.remove(FileName)
+            self._CheckClosing(Wait=True)
+        finally:
+            self.Finalizer.shutdown(wait=True)
+            if self.Pool is not None:
+                self.Pool.shutdown()
+
+
+def RawToH5(RawFile, H5File=None, ChunkSize=2**16, **FileBufferKwargs):
+    '''Converts a raw recording of RawFileBuffer to the FileBuffer h5
+       layout, reading ChunkSize samples at a time
+       RawFile: str. Raw file name
+       H5File: str. h5 file name, by default the raw name with .h5
+       FileBufferKwargs: arguments of FileBuffer, MaxSize None by default
+    '''
+    Data, Header = LoadRaw(RawFile)
+    if H5File is None:
+        H5File = os.path.splitext(RawFile)[0] + '.h5'
+    FileBufferKwargs.setdefault('MaxSize', None)
+    FileBufferKwargs.setdefault('dtype', Header['dtype'])
+    FileBufferKwargs.setdefault('Fs', Header['Fs'])
+    FileBufferKwargs.setdefault('ScalingCoeffs', Header.get('ScalingCoeffs'))
+    FileBuff = FileBuffer(FileName=H5File,
+                          nChannels=Header['nChannels'],
+                          **FileBufferKwargs)
+    for ind in range(0, Data.shape[0], ChunkSize):
+        FileBuff.AddSample(np.asarray(Data[ind:ind + ChunkSize, :]))
+    FileBuff.Close()
+    return H5File
+
 
 class DataSavingThread(Qt.QThread):
-    def __init__(self, FileName, nChannels, MaxSize=None, dtype='float'):
+    def __init__(self, FileName, nChannels, MaxSize=None, dtype='f4',
+                 Compression='gzip', GzipLevel=4, CompressThreads=0,
+                 MaxTime=None, MaxSamples=None, Fs=None, Backend='h5',
+                 ChNames=None, Overview=False, Swmr=False,
+                 ScalingCoeffs=None, QueueDepth=8,
+                 QueuePolicy='drop-oldest', PoolSize=None):
+        '''Saves the blocks added with AddData in its own thread
+           Backend: str. 'h5' saves with FileBuffer. 'raw' appends the
+                         blocks to a memory mapped file with RawFileBuffer,
+                         only dtype, Fs, ChNames and ScalingCoeffs are used
+           dtype: str. Data type saved, 'i2' with the ScalingCoeffs of
+                       ReadAnalog to save the raw codes of RawInt16 mode
+           PoolSize: int. PoolSize of ReadAnalog.ReadContData, QueueDepth
+                          must be smaller so the queued blocks are not
+                          overwritten. The overwritten blocks are not saved
+                          and are counted as gaps
+        '''
         super(DataSavingThread, self).__init__()
-        self.NewData = None
+        if PoolSize is not None and QueueDepth >= PoolSize:
+            raise ValueError('QueueDepth {} must be smaller than the '
+                             'PoolSize {}'.format(QueueDepth, PoolSize))
+        self.Queue = BlockQueue(Depth=QueueDepth,
+                                Policy=QueuePolicy,
+                                Name='Saving')
+        self.Metrics = StageMetrics('Saving', self.Queue)
+        self.Profiler = ThreadProfiler('Saving', Wake=self.Queue.Wake)
+        self.Running = True
+        if Backend == 'raw':
+            Ignored = [n for n, v in (('MaxSize', MaxSize),
+                                      ('MaxTime', MaxTime),
+                                      ('MaxSamples', MaxSamples),
+                                      ('Overview', Overview),
+                                      ('Swmr', Swmr)) if v]
+            if Compression != 'none':
+                Ignored.append('Compression')
+            if Ignored:
+                log.warning('Raw backend ignores %s', ', '.join(Ignored))
+            self.FileBuff = RawFileBuffer(FileName=FileName,
+                                          nChannels=nChannels,
+                                          dtype=dtype,
+                                          Fs=Fs,
+                                          ChNames=ChNames,
+                                          ScalingCoeffs=ScalingCoeffs)
+            return
         self.FileBuff = FileBuffer(FileName=FileName,
                                    nChannels=nChannels,
-                                   MaxSize=MaxSize)
+                                   MaxSize=MaxSize,
+                                   dtype=dtype,
+                                   Compression=Compression,
+                                   GzipLevel=GzipLevel,
+                                   CompressThreads=CompressThreads,
+                                   MaxTime=MaxTime,
+                                   MaxSamples=MaxSamples,
+                                   Fs=Fs,
+                                   Overview=Overview,
+                                   Swmr=Swmr,
+                                   ScalingCoeffs=ScalingCoeffs)
 
     def run(self, *args, **kwargs):
         while True:
-            if self.NewData is not None:
-                self.FileBuff.AddSample(self.NewData)
-                self.NewData = None
-            else:
-                Qt.QThread.msleep(10)
+            self.Profiler.Check()
+            NewData = self.Queue.Get(Wait=True,
+                                     Timeout=self.Profiler.GetTimeout())
+            if NewData is None:
+                if not self.Running:
+                    break
+                continue
+            if IsOverrun(NewData):
+                self.Metrics.CheckBlock(NewData)
+                continue
+            self.Metrics.StartBlock()
+            Written = self.FileBuff.BytesWritten
+            self.FileBuff.AddSample(NewData)
+            self.Metrics.EndBlock(NewData.shape[0],
+                                  self.FileBuff.BytesWritten - Written,
+                                  Block=NewData)
+        self.Profiler.Stop()
 
     def AddData(self, NewData):
-        if self.NewData is not None:
-            print('Error Saving !!!!')
-        self.NewData = NewData
-    
-    def stop (self):
-        self.FileBuff.h5File.close()
-        self.terminate()
+        self.Queue.Put(NewData)
 
+    def stop(self):
+        '''Saves the pending blocks, ends the thread and closes the file
+        '''
+        self.Running = False
+        self.Queue.Close()
+        self.wait()
+        self.FileBuff.Close()
 
 
 SaveStatePars = [{'name': 'Save State',
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy access to the recordings saved by FileBuffer
+"""
+
+import glob
+import os
+import re
+import time
+import h5py
+import numpy as np
+
+from PyqtTools.BlockModule import ScaleRaw
+
+
+def FindParts(FileName):
+    '''Returns the part files of a recording sorted by part number,
+       FileName_0.h5, FileName_1.h5 ... or FileName.h5 if it was not split
+    '''
+    FileBase = FileName.split('.h5')[0]
+    Parts = []
+    for PartFile in glob.glob(glob.escape(FileBase) + '_*.h5'):
+        Match = re.match(re.escape(FileBase) + r'_(\d+)\.h5$', PartFile)
+        if Match:
+            Parts.append((int(Match.group(1)), PartFile))
+    if Parts:
+        return [PartFile for _, PartFile in sorted(Parts)]
+    if os.path.isfile(FileBase + '.h5'):
+        return [FileBase + '.h5', ]
+    raise FileNotFoundError('No recording found for {}'.format(FileName))
+
+
+def ChannelSelection(nChannels, Channels):
+    '''Returns the channel selection for h5py, that needs increasing
+       indexes, and the indexes to reorder it as requested
+    '''
+    Chs = np.arange(nChannels)[Channels]
+    Sorted, Inverse = np.unique(np.atleast_1d(Chs), return_inverse=True)
+    if np.array_equal(Sorted, np.arange(nChannels)):
+        return Chs, slice(None), Inverse
+    return Chs, list(Sorted), Inverse
+
+
+class RecordReader():
+    def __init__(self, FileName, Scaled=True):
+        '''Presents the parts of a recording as one (samples, channels)
+           array. Only the requested samples are read from disk.
+           FileName: str. Recording file name as given to FileBuffer
+           Scaled: bool. If the recording has ScalingCoeffs (raw int16
+                         codes) the samples are returned in volts
+
+           Reader = RecordReader('Rec.h5')
+           Reader[1000:2000, [0, 3]]
+           Reader.GetTime(10, 20, Channels=[0, 3])
+           for Chunk in Reader.IterChunks(2**16):
+               ...
+        '''
+        self.Parts = FindParts(FileName)
+        self.Files = []
+        self.Dsets = []
+        self.Index = []  # (First sample, Last sample + 1) of each part
+        nSamps = 0
+        for PartFile in self.Parts:
+            h5File = h5py.File(PartFile, 'r')
+            if 'data' not in h5File:
+                h5File.close()
+                continue
+            Dset = h5File['data']
+            nValid = Dset.shape[0]
+            if 'nValid' in h5File:
+                # Samples flushed, the rest of the rows are preallocated
+                nValid = min(nValid, int(h5File['nValid'][0]))
+            self.Files.append(h5File)
+            self.Dsets.append(Dset)
+            self.Index.append((nSamps, nSamps + nValid))
+            nSamps += nValid
+        if not self.Dsets:
+            raise ValueError('{} has no data'.format(FileName))
+
+        self.nSamps = nSamps
+        self.nChannels = self.Dsets[0].shape[1]
+        # dtype of the samples returned, RawDtype of the samples on disk
+        self.RawDtype = self.Dsets[0].dtype
+        self.dtype = self.RawDtype
+        Attrs = self.Files[0].attrs
+        self.Fs = Attrs['Fs'] if 'Fs' in Attrs else None
+        self.StartTime = Attrs['StartTime'] if 'StartTime' in Attrs else None
+        self.ScalingCoeffs = None
+        if Scaled and 'ScalingCoeffs' in Attrs:
+            self.ScalingCoeffs = Attrs['ScalingCoeffs']
+            self.dtype = np.dtype(np.float64)
+
+    @property
+    def shape(self):
+        return (self.nSamps, self.nChannels)
+
+    def __len__(self):
+        return self.nSamps
+
+    def __getitem__(self, Key):
+        if not isinstance(Key, tuple):
+            Key = (Key, slice(None))
+        Samps, Channels = Key
+        if isinstance(Samps, (int, np.integer)):
+            if Samps < 0:
+                Samps += self.nSamps
+            return self.Read(Samps, Samps + 1, Channels)[0]
+        Start, Stop, Step = Samps.indices(self.nSamps)
+        if Step != 1:
+            return self.Read(Start, Stop, Channels)[::Step]
+        return self.Read(Start, Stop, Channels)
+
+    def Read(self, Start, Stop, Channels=slice(None)):
+        '''Returns the samples [Start, Stop) of the selected channels
+           Channels: slice, int or list of channel indexes
+        '''
+        Start = max(0, Start)
+        Stop = min(self.nSamps, Stop)
+        Chs, ChSel, Inverse = ChannelSelection(self.nChannels, Channels)
+        Out = np.empty((max(0, Stop - Start), np.size(Chs)),
+                       dtype=self.RawDtype)
+        for Dset, (First, Last) in zip(self.Dsets, self.Index):
+            if Last <= Start or First >= Stop:
+                continue
+            a = max(Start, First)
+            b = min(Stop, Last)
+            Out[a - Start:b - Start, :] = Dset[a - First:b - First,
+                                               ChSel][:, Inverse]
+        if self.ScalingCoeffs is not None:
+            Out = ScaleRaw(Out, self.ScalingCoeffs[np.atleast_1d(Chs)])
+        if np.ndim(Chs) == 0:
+            return Out[:, 0]
+        return Out
+
+    def GetTime(self, Tstart, Tstop, Channels=slice(None)):
+        '''Returns the samples between Tstart and Tstop (s) from the
+           recording start
+        '''
+        if self.Fs is None:
+            raise ValueError('Recording saved without Fs')
+        return self.Read(int(round(Tstart*self.Fs)),
+                         int(round(Tstop*self.Fs)),
+                         Channels)
+
+    def IterChunks(self, ChunkSize, Channels=slice(None),
+                   Start=0, Stop=None):
+        '''Yields consecutive blocks of ChunkSize samples, the last one can
+           be shorter
+        '''
+        if Stop is None:
+            Stop = self.nSamps
+        for ind in range(Start, Stop, ChunkSize):
+            yield self.Read(ind, min(ind + ChunkSize, Stop), Channels)
+
+    def GetOverviewFactors(self):
+        '''Returns the samples per bin of each overview level, empty if the
+           recording was saved without overview
+        '''
+        if 'overview' not in self.Files[0]:
+            return []
+        Group = self.Files[0]['overview']
+        return [Group['L{}'.format(lev)].attrs['Factor']
+                for lev in range(len(Group))]
+
+    def GetOverview(self, Start=0, Stop=None, Channels=slice(None),
+                    nPoints=4000):
+        '''Returns the min, max and mean of the samples [Start, Stop) in
+           about nPoints bins. They are read from the coarsest overview
+           level that gives at least that resolution and merged. If the
+           range has less than nPoints samples the data itself is returned.
+           Returns (Inds, Min, Max, Mean), Inds is the first sample of each
+           bin and the others are (bins, channels) arrays
+        '''
+        if Stop is None:
+            Stop = self.nSamps
+        Start = max(0, Start)
+        Stop = min(self.nSamps, Stop)
+        if Stop - Start <= nPoints:
+            Data = self.Read(Start, Stop, Channels)
+            return np.arange(Start, Stop), Data, Data, Data
+
+        Factors = self.GetOverviewFactors()
+        if not Factors:
+            raise ValueError('Recording saved without overview')
+        lev = len(Factors) - 1
+        for ind, Factor in enumerate(Factors):
+            if (Stop - Start)/Factor <= nPoints:
+                lev = max(0, ind - 1)
+                break
+        Factor = Factors[lev]
+
+        Chs, ChSel, Inverse = ChannelSelection(self.nChannels, Channels)
+        Inds = []
+        Bins = []
+        for h5File, (First, Last) in zip(self.Files, self.Index):
+            if Last <= Start or First >= Stop:
+                continue
+            Dset = h5File['overview/L{}'.format(lev)]
+            a = (max(Start, First) - First)//Factor
+            b = min(-(-(min(Stop, Last) - First)//Factor), Dset.shape[0])
+            Inds.append(First + np.arange(a, b)*Factor)
+            Bins.append(Dset[a:b, :, ChSel][:, :, Inverse])
+        Inds = np.concatenate(Inds)
+        Bins = np.concatenate(Bins)
+        if self.ScalingCoeffs is not None:
+            # The scaling is monotonic and almost linear
+            Bins = ScaleRaw(Bins, self.ScalingCoeffs[np.atleast_1d(Chs)])
+        Min, Max, Mean = Bins[:, 0], Bins[:, 1], Bins[:, 2]
+        Merge = Inds.size//nPoints
+        if Merge > 1:
+            Edges = np.arange(0, Inds.size, Merge)
+            Cnt = np.diff(np.append(Edges, Inds.size))
+            Min = np.minimum.reduceat(Min, Edges, axis=0)
+            Max = np.maximum.reduceat(Max, Edges, axis=0)
+            Mean = np.add.reduceat(Mean, Edges, axis=0)/Cnt[:, None]
+            Inds = Inds[Edges]
+        if np.ndim(Chs) == 0:
+            return Inds, Min[:, 0], Max[:, 0], Mean[:, 0]
+        return Inds, Min, Max, Mean
+
+    def Close(self):
+        for h5File in self.Files:
+            h5File.close()
+        self.Files = []
+        self.Dsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+class TailReader():
+    def __init__(self, FileName, Channels=slice(None), Scaled=True,
+                 PollTime=0.1, Timeout=None):
+        '''Reads a recording saved by FileBuffer with Swmr=True while it is
+           written, following its parts. Iterating yields the new blocks
+           of samples until the recording is closed.
+           FileName: str. Recording file name as given to FileBuffer
+           Channels: slice, int or list of channel indexes
+           Scaled: bool. The raw int16 codes are returned in volts
+           PollTime: float. Seconds between checks for new samples
+           Timeout: float. Stops iterating if no samples arrive in this
+                           time (s), None waits forever
+
+           for Block in TailReader('Rec.h5', Channels=[0, 1]):
+               ...
+        '''
+        self.FileBase = FileName.split('.h5')[0]
+        self.Channels = Channels
+        self.Scaled = Scaled
+        self.PollTime = PollTime
+        self.Timeout = Timeout
+        self.Split = None
+        self.PartInd = 0
+        self.h5File = None
+        self.nRead = 0
+        self.TotalRead = 0
+        self.Finished = False
+
+    def _PartName(self):
+        if self.Split is None:
+            if os.path.isfile('{}_0.h5'.format(self.FileBase)):
+                self.Split = True
+            elif os.path.isfile(self.FileBase + '.h5'):
+                self.Split = False
+            else:
+                return None
+        if self.Split:
+            return '{}_{}.h5'.format(self.FileBase, self.PartInd)
+        return self.FileBase + '.h5'
+
+    def _OpenPart(self):
+        PartFile = self._PartName()
+        if PartFile is None:
+            return
+        if not os.path.isfile(PartFile):
+            # The part opened in advance is removed when recording stops
+            if self.PartInd > 0:
+                self.Finished = True
+            return
+        try:
+            h5File = h5py.File(PartFile, 'r', libver='latest', swmr=True)
+        except OSError:
+            # Not in SWMR mode until the writer gets the first block
+            return
+        if 'nValid' not in h5File:
+            h5File.close()
+            return
+        self.h5File = h5File
+        self.Dset = h5File['data']
+        self.ValidDset = h5File['nValid']
+        self.nRead = 0
+        self.Chs, self.ChSel, self.Inverse = ChannelSelection(
+            self.Dset.shape[1], self.Channels)
+        self.ScalingCoeffs = None
+        if self.Scaled and 'ScalingCoeffs' in h5File.attrs:
+            Coeffs = h5File.attrs['ScalingCoeffs']
+            self.ScalingCoeffs = Coeffs[np.atleast_1d(self.Chs)]
+
+    def Poll(self):
+        '''Returns the samples written since the last call or None
+        '''
+        if self.h5File is None:
+            self._OpenPart()
+            if self.h5File is None:
+                return None
+        self.ValidDset.refresh()
+        nValid, Closed = self.ValidDset[:]
+        Block = None
+        if nValid > self.nRead:
+            self.Dset.refresh()
+            Block = self.Dset[self.nRead:nValid, self.ChSel][:, self.Inverse]
+            Block = ScaleRaw(Block, self.ScalingCoeffs)
+            if np.ndim(self.Chs) == 0:
+                Block = Block[:, 0]
+            self.nRead = nValid
+            self.TotalRead += Block.shape[0]
+        if Closed:
+            self.h5File.close()
+            self.h5File = None
+            self.PartInd += 1
+            if not self.Split:
+                self.Finished = True
+        return Block
+
+    def __iter__(self):
+        LastData = time.time()
+        while not self.Finished:
+            Block = self.Poll()
+            if Block is not None:
+                LastData = time.time()
+                yield Block
+                continue
+            if (self.Timeout is not None and
+                    time.time() - LastData > self.Timeout):
+                break
+            time.sleep(self.PollTime)
+        self.Close()
+
+    def Close(self):
+        if self.h5File is not None:
+            self.h5File.close()
+            self.h5File = None
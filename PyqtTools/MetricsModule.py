@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Live metrics of the pipeline stages, a parameter tree panel to show them
+and an optional csv log
+"""
+
+import copy
+import threading
+import time
+import pyqtgraph.parametertree.parameterTypes as pTypes
+from PyQt5 import Qt
+
+from PyqtTools.BlockModule import GetBlockAge, IsOverrun
+
+
+MetricsFields = ('SampleRate', 'BlockRate', 'ProcTime', 'MaxProcTime',
+                 'Load', 'QueueDepth', 'Dropped', 'BytesWritten',
+                 'RefreshRate', 'Age', 'MaxAge', 'Gaps', 'Overruns')
+
+
+class StageMetrics():
+    def __init__(self, Name, Queue=None):
+        '''Counters of a pipeline stage, updated from the stage thread and
+           read periodically with GetStats
+           Name: str. Stage name
+           Queue: BlockQueue. Input queue of the stage, if any
+        '''
+        self.Name = Name
+        self.Queue = Queue
+        self.Lock = threading.Lock()
+        self.BlockStart = None
+        self.TotalSamps = 0
+        self.TotalBlocks = 0
+        self.TotalBytes = 0
+        self.TotalRefresh = 0
+        self.LastSeqNum = None
+        self.Gaps = 0
+        self.Overruns = 0
+        self._ResetWindow()
+
+    def _ResetWindow(self):
+        self.WinStart = time.perf_counter()
+        self.WinSamps = 0
+        self.WinBlocks = 0
+        self.WinRefresh = 0
+        self.WinProcTime = 0
+        self.WinMaxProcTime = 0
+        self.WinAge = 0
+        self.WinnAge = 0
+        self.WinMaxAge = 0
+
+    def StartBlock(self):
+        self.BlockStart = time.perf_counter()
+
+    def EndBlock(self, nSamps=0, nBytes=0, Block=None, AcqTime=None):
+        '''Ends the processing of a block started with StartBlock
+           nSamps: int. Samples of the block
+           nBytes: int. Bytes written to disk
+           Block: DataBlock. If given its age, sequence number and overrun
+                             are tracked
+           AcqTime: float. Acquisition time to track only the age, for
+                           stages that do not process the blocks directly
+        '''
+        if Block is not None:
+            self.CheckBlock(Block)
+        elif AcqTime is not None:
+            self._AddAge(time.time() - AcqTime)
+        ProcTime = 0
+        if self.BlockStart is not None:
+            ProcTime = time.perf_counter() - self.BlockStart
+            self.BlockStart = None
+        with self.Lock:
+            self.WinProcTime += ProcTime
+            self.WinMaxProcTime = max(self.WinMaxProcTime, ProcTime)
+            self.WinBlocks += 1
+            self.TotalBlocks += 1
+            self.WinSamps += nSamps
+            self.TotalSamps += nSamps
+            self.TotalBytes += nBytes
+
+    def AddSamples(self, nSamps, Block=None):
+        '''Counts samples received without a processing time, for stages
+           that buffer the blocks in the producer thread
+        '''
+        with self.Lock:
+            self.WinSamps += nSamps
+            self.TotalSamps += nSamps
+            if Block is not None:
+                self._CheckSeq(Block)
+
+    def CheckBlock(self, Block):
+        '''Tracks the age of a DataBlock and the missing sequence numbers
+           before it, plain arrays are ignored. Call it once the block has
+           been used, a block whose pool buffer was overwritten meanwhile
+           is counted as an overrun and as a gap
+        '''
+        Age = GetBlockAge(Block)
+        if Age is not None:
+            self._AddAge(Age)
+        with self.Lock:
+            self._CheckSeq(Block)
+            if IsOverrun(Block):
+                self.Overruns += 1
+                self.Gaps += 1
+
+    def _AddAge(self, Age):
+        with self.Lock:
+            self.WinAge += Age
+            self.WinnAge += 1
+            self.WinMaxAge = max(self.WinMaxAge, Age)
+
+    def _CheckSeq(self, Block):
+        SeqNum = getattr(Block, 'SeqNum', None)
+        if SeqNum is None:
+            return
+        if self.LastSeqNum is not None:
+            if SeqNum > self.LastSeqNum + 1:
+                self.Gaps += SeqNum - self.LastSeqNum - 1
+            elif SeqNum < self.LastSeqNum:
+                # New acquisition
+                self.LastSeqNum = None
+        if self.LastSeqNum is None or SeqNum > self.LastSeqNum:
+            self.LastSeqNum = SeqNum
+
+    def AddRefresh(self):
+        with self.Lock:
+            self.WinRefresh += 1
+            self.TotalRefresh += 1
+
+    def GetStats(self):
+        '''Returns the metrics since the last call
+           {'SampleRate': samples/s,
+            'BlockRate': blocks/s,
+            'ProcTime': mean processing time of the blocks (s),
+            'MaxProcTime': max processing time of the blocks (s),
+            'Load': fraction of the time processing blocks,
+            'QueueDepth': blocks waiting in the input queue,
+            'Dropped': total blocks dropped by the input queue,
+            'BytesWritten': total bytes written,
+            'RefreshRate': refreshes/s,
+            'Age': mean time from the acquisition of the blocks to the
+                   end of their processing (s),
+            'MaxAge': max age of the blocks (s),
+            'Gaps': total blocks missing in the sequence or overrun,
+            'Overruns': total blocks overwritten in their pool before
+                        being used}
+        '''
+        with self.Lock:
+            Now = time.perf_counter()
+            Elapsed = max(Now - self.WinStart, 1e-9)
+            Stats = {'SampleRate': self.WinSamps/Elapsed,
+                     'BlockRate': self.WinBlocks/Elapsed,
+                     'ProcTime': (self.WinProcTime/self.WinBlocks
+                                  if self.WinBlocks else 0),
+                     'MaxProcTime': self.WinMaxProcTime,
+                     'Load': self.WinProcTime/Elapsed,
+                     'QueueDepth': 0,
+                     'Dropped': 0,
+                     'BytesWritten': self.TotalBytes,
+                     'RefreshRate': self.WinRefresh/Elapsed,
+                     'Age': (self.WinAge/self.WinnAge
+                             if self.WinnAge else 0),
+                     'MaxAge': self.WinMaxAge,
+                     'Gaps': self.Gaps,
+                     'Overruns': self.Overruns}
+            self._ResetWindow()
+        if self.Queue is not None:
+            Counters = self.Queue.GetCounters()
+            Stats['QueueDepth'] = Counters['Depth']
+            Stats['Dropped'] = Counters['Dropped']
+        return Stats
+
+
+class MetricsLogger():
+    def __init__(self, FileName):
+        '''Appends the metrics of the stages to a csv file, one row per
+           stage and update
+        '''
+        self.File = open(FileName, 'a')
+        if self.File.tell() == 0:
+            self.File.write('Time,Stage,{}\n'.format(','.join(MetricsFields)))
+
+    def Write(self, Stage, Stats, Time=None):
+        if Time is None:
+            Time = time.time()
+        Vals = ','.join('{:.6g}'.format(Stats[f]) for f in MetricsFields)
+        self.File.write('{:.3f},{},{}\n'.format(Time, Stage, Vals))
+
+    def Flush(self):
+        self.File.flush()
+
+    def Close(self):
+        self.File.close()
+
+
+StagePars = {'name': 'Stage',
+             'type': 'group',
+             'children': [{'name': 'SampleRate',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 'Sa/s'},
+                          {'name': 'BlockRate',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 'Hz'},
+                          {'name': 'ProcTime',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 's'},
+                          {'name': 'MaxProcTime',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 's'},
+                          {'name': 'Load',
+                           'type': 'float',
+                           'readonly': True},
+                          {'name': 'QueueDepth',
+                           'type': 'int',
+                           'readonly': True},
+                          {'name': 'Dropped',
+                           'type': 'int',
+                           'readonly': True},
+                          {'name': 'BytesWritten',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 'B'},
+                          {'name': 'RefreshRate',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 'Hz'},
+                          {'name': 'Age',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 's'},
+                          {'name': 'MaxAge',
+                           'type': 'float',
+                           'readonly': True,
+                           'siPrefix': True,
+                           'suffix': 's'},
+                          {'name': 'Gaps',
+                           'type': 'int',
+                           'readonly': True},
+                          {'name': 'Overruns',
+                           'type': 'int',
+                           'readonly': True}]
+             }
+
+MetricsPars = ({'name': 'UpdateTime',
+                'type': 'float',
+                'value': 1,
+                'step': 0.5,
+                'limits': (0.1, 60),
+                'siPrefix': True,
+                'suffix': 's'},
+               {'name': 'LogCSV',
+                'title': 'Log to CSV',
+                'type': 'bool',
+                'value': False},
+               {'name': 'LogFile',
+                'type': 'str',
+                'value': 'Metrics.csv'},
+               {'name': 'Stages',
+                'type': 'group',
+                'children': []},)
+
+
+class MetricsParameters(pTypes.GroupParameter):
+    def __init__(self, **kwargs):
+        '''Panel with the live metrics of the added stages
+
+           MetricsPars = MetricsParameters(name='Metrics')
+           MetricsPars.AddStage(threadDemod.Metrics)
+           MetricsPars.Start()
+        '''
+        pTypes.GroupParameter.__init__(self, **kwargs)
+
+        self.addChildren(MetricsPars)
+        self.Stages = []
+        self.Logger = None
+        self.Timer = Qt.QTimer()
+        self.Timer.timeout.connect(self.Update)
+        self.param('UpdateTime').sigValueChanged.connect(
+            self.on_UpdateTime_changed)
+        self.param('LogCSV').sigValueChanged.connect(self.on_LogCSV_changed)
+
+    def AddStage(self, Metrics):
+        '''Metrics: StageMetrics. Metrics of a stage, the Metrics attribute
+                                  of the pipeline threads
+        '''
+        self.RemoveStage(Metrics.Name)
+        self.Stages.append(Metrics)
+        Stage = copy.deepcopy(StagePars)
+        Stage['name'] = Metrics.Name
+        self.param('Stages').addChild(Stage)
+
+    def RemoveStage(self, Name):
+        for Metrics in self.Stages:
+            if Metrics.Name == Name:
+                self.Stages.remove(Metrics)
+                self.param('Stages').removeChild(
+                    self.param('Stages').child(Name))
+                break
+
+    def Start(self):
+        self.Timer.start(int(self.param('UpdateTime').value()*1000))
+
+    def Stop(self):
+        self.Timer.stop()
+        if self.Logger is not None:
+            self.Logger.Close()
+            self.Logger = None
+
+    def on_UpdateTime_changed(self):
+        if self.Timer.isActive():
+            self.Start()
+
+    def on_LogCSV_changed(self):
+        if self.param('LogCSV').value():
+            self.Logger = MetricsLogger(self.param('LogFile').value())
+        elif self.Logger is not None:
+            self.Logger.Close()
+            self.Logger = None
+
+    def Update(self):
+        Now = time.time()
+        for Metrics in self.Stages:
+            Stats = Metrics.GetStats()
+            Stage = self.param('Stages').child(Metrics.Name)
+            for Field, Val in Stats.items():
+                Stage.child(Field).setValue(Val)
+            if self.Logger is not None:
+                self.Logger.Write(Metrics.Name, Stats, Now)
+        if self.Logger is not None:
+            self.Logger.Flush()
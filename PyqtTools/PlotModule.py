@@ -9,9 +9,15 @@ Created on Fri Mar  1 18:44:39 2019
 import pyqtgraph.parametertree.parameterTypes as pTypes
 import pyqtgraph as pg
 import copy
+import threading
+import time
 from PyQt5 import Qt
 import numpy as np
-from scipy.signal import welch
+from scipy.signal import get_window
+
+from PyqtTools.BlockModule import BlockQueue, ScaleRaw
+from PyqtTools.MetricsModule import StageMetrics
+from PyqtTools.ProfilerModule import ThreadProfiler
 
 
 ChannelPars = {'name': 'Ch01',
@@ -147,7 +153,7 @@ class PgPlotWindow(Qt.QWidget):
 class Buffer2D(np.ndarray):
     def __new__(subtype, Fs, nChannels, ViewBuffer,
                 dtype=float, buffer=None, offset=0,
-                strides=None, order=None, info=None):
+                strides=None, order=None, info=None, Circular=False):
         # Create the ndarray instance of our type, given the usual
         # ndarray input arguments.  This will call the standard
         # ndarray constructor, but return an object of our type.
@@ -162,6 +168,10 @@ class Buffer2D(np.ndarray):
         obj.totalind = 0
         obj.Fs = float(Fs)
         obj.Ts = 1/obj.Fs
+        # In circular mode the newest sample is at WriteInd-1 and data
+        # is not shifted on every AddData
+        obj.Circular = Circular
+        obj.WriteInd = 0
         # Finally, we must return the newly created object:
         return obj
 
@@ -172,11 +182,62 @@ class Buffer2D(np.ndarray):
         self.bufferind = getattr(obj, 'bufferind', None)
 
     def AddData(self, NewData):
+        '''NewData: array. (samples, channels), if it is a DataBlock the
+                           time of the samples is taken from its StartInd
+        '''
         newsize = NewData.shape[0]
-        self[0:-newsize, :] = self[newsize:, :]
-        self[-newsize:, :] = NewData
+        if self.Circular:
+            self._AddCircular(NewData)
+        else:
+            self[0:-newsize, :] = self[newsize:, :]
+            self[-newsize:, :] = NewData
         self.counter += newsize
-        self.totalind += newsize
+        StartInd = getattr(NewData, 'StartInd', None)
+        if StartInd is None:
+            self.totalind += newsize
+        else:
+            self.totalind = StartInd + newsize
+
+    def _AddCircular(self, NewData):
+        BufferSize = self.shape[0]
+        newsize = NewData.shape[0]
+        if newsize >= BufferSize:
+            self[:, :] = NewData[-BufferSize:, :]
+            self.WriteInd = 0
+            return
+        start = self.WriteInd
+        stop = start + newsize
+        if stop <= BufferSize:
+            self[start:stop, :] = NewData
+        else:
+            split = BufferSize - start
+            self[start:, :] = NewData[:split, :]
+            self[:stop - BufferSize, :] = NewData[split:, :]
+        self.WriteInd = stop % BufferSize
+
+    def GetViews(self, Size):
+        '''Returns the last Size samples as a tuple of one or two views of
+           the buffer, ordered from oldest to newest. No data is copied.
+        '''
+        BufferSize = self.shape[0]
+        Size = min(Size, BufferSize)
+        Data = self.view(np.ndarray)
+        if not self.Circular:
+            return (Data[BufferSize - Size:, :], )
+        start = self.WriteInd - Size
+        if start >= 0:
+            return (Data[start:self.WriteInd, :], )
+        return (Data[start:, :], Data[:self.WriteInd, :])
+
+    def GetData(self, Size):
+        '''Returns the last Size samples ordered from oldest to newest.
+           It is a view when the samples are contiguous in memory, otherwise
+           a single stitched copy.
+        '''
+        Views = self.GetViews(Size)
+        if len(Views) == 1:
+            return Views[0]
+        return np.concatenate(Views, axis=0)
 
     def IsFilled(self):
         return self.counter >= self.shape[0]
@@ -198,9 +259,65 @@ labelStyle = {'color': '#FFF',
               'bold': True}
 
 
+class OverviewPlot():
+    def __init__(self, Reader, PlotItem, Channel=0, nPoints=4000,
+                 Color='b'):
+        '''Draws a channel of a long recording from its overview pyramid.
+           The min max envelope and the mean are read again from the
+           reader each time the x range of the plot changes.
+           Reader: FileReaderModule.RecordReader. Opened recording
+           PlotItem: pg.PlotItem. Plot where the curves are added
+           Channel: int. Channel index
+           nPoints: int. Approximate number of bins drawn
+        '''
+        self.Reader = Reader
+        self.Plot = PlotItem
+        self.Channel = Channel
+        self.nPoints = nPoints
+        self.Ts = 1/float(Reader.Fs) if Reader.Fs else 1
+
+        self.MinCurve = PlotItem.plot(pen=pg.mkPen(Color, width=0.5))
+        self.MaxCurve = PlotItem.plot(pen=pg.mkPen(Color, width=0.5))
+        self.Fill = pg.FillBetweenItem(self.MinCurve, self.MaxCurve,
+                                       brush=pg.mkBrush(Color))
+        PlotItem.addItem(self.Fill)
+        self.MeanCurve = PlotItem.plot(pen=pg.mkPen('w'))
+        if Reader.Fs:
+            PlotItem.setLabel('bottom', 'Time', units='s', **labelStyle)
+        else:
+            PlotItem.setLabel('bottom', 'Samps', **labelStyle)
+
+        self.Update()
+        PlotItem.setXRange(0, Reader.nSamps*self.Ts, padding=0)
+        PlotItem.sigXRangeChanged.connect(self.Update)
+
+    def Update(self, *args):
+        if args:
+            Tstart, Tstop = self.Plot.viewRange()[0]
+            Start = int(Tstart/self.Ts)
+            Stop = int(Tstop/self.Ts) + 1
+        else:
+            Start, Stop = 0, self.Reader.nSamps
+        Start = max(0, Start)
+        Stop = min(self.Reader.nSamps, Stop)
+        if Stop <= Start:
+            return
+        Inds, Min, Max, Mean = self.Reader.GetOverview(Start, Stop,
+                                                       self.Channel,
+                                                       self.nPoints)
+        t = Inds*self.Ts
+        self.MinCurve.setData(t, Min)
+        self.MaxCurve.setData(t, Max)
+        self.MeanCurve.setData(t, Mean)
+
+
 class Plotter(Qt.QThread):
     def __init__(self, Fs, nChannels, ViewBuffer, ViewTime, RefreshTime,
-                 ChannelConf, ShowTime=True):
+                 ChannelConf, ShowTime=True, ScalingCoeffs=None):
+        '''ScalingCoeffs: array. If given the blocks are raw int16 codes,
+                                  they are buffered as they are and scaled
+                                  only when drawn, see BlockModule.ScaleRaw
+        '''
         super(Plotter, self).__init__()
 
         self.Winds = []
@@ -211,7 +328,17 @@ class Plotter(Qt.QThread):
         self.ShowTime = ShowTime
         self.Fs = Fs
         self.Ts = 1/float(self.Fs)
-        self.Buffer = Buffer2D(Fs, nChannels, ViewBuffer)
+        self.ScalingCoeffs = ScalingCoeffs
+        if ScalingCoeffs is None:
+            self.Buffer = Buffer2D(Fs, nChannels, ViewBuffer, Circular=True)
+        else:
+            self.Buffer = Buffer2D(Fs, nChannels, ViewBuffer, Circular=True,
+                                   dtype=np.int16)
+        self.DataReady = threading.Event()
+        self.Metrics = StageMetrics('Plotter')
+        self.LastAcqTime = None
+        self.Profiler = ThreadProfiler('Plotter', Wake=self.DataReady.set)
+        self.Running = True
         self.SetRefreshTime(RefreshTime)
         self.SetViewTime(ViewTime)
 
@@ -259,30 +386,42 @@ class Plotter(Qt.QThread):
         self.RefreshInd = int(RefreshTime/self.Ts)
 
     def run(self, *args, **kwargs):
-        while True:
+        while self.Running:
+            self.DataReady.wait(self.Profiler.GetTimeout())
+            self.DataReady.clear()
+            self.Profiler.Check()
             if self.Buffer.counter > self.RefreshInd:
+                self.Metrics.StartBlock()
                 if self.ShowTime:
                     t = self.Buffer.GetTimes(self.ViewInd)
                 self.Buffer.Reset()
+                ViewData = ScaleRaw(self.Buffer.GetData(self.ViewInd),
+                                    self.ScalingCoeffs)
                 for i in range(self.nChannels):
                     if self.ShowTime:
-                        self.Curves[i].setData(t, self.Buffer[-self.ViewInd:, i])
+                        self.Curves[i].setData(t, ViewData[:, i])
                     else:
-                        self.Curves[i].setData(self.Buffer[-self.ViewInd:, i])
+                        self.Curves[i].setData(ViewData[:, i])
+                self.Metrics.EndBlock(AcqTime=self.LastAcqTime)
+                self.Metrics.AddRefresh()
 #                    self.Curves[i].setData(NewData[:, i])
 #                self.Plots[i].setXRange(self.BufferSize/10,
 #                                        self.BufferSize)
-            else:
-#                pg.QtGui.QApplication.processEvents()
-                Qt.QThread.msleep(10)
+        self.Profiler.Stop()
 
     def AddData(self, NewData):
         self.Buffer.AddData(NewData)
+        self.Metrics.AddSamples(NewData.shape[0], NewData)
+        self.LastAcqTime = getattr(NewData, 'AcqTime', None)
+        if self.Buffer.counter > self.RefreshInd:
+            self.DataReady.set()
 
     def stop(self):
+        self.Running = False
+        self.DataReady.set()
+        self.wait()
         for wind in self.Winds:
             wind.close()
-        self.terminate()
 
 ##############################################################################
 
@@ -313,6 +452,16 @@ PSDPars = ({'name': 'Fs',
             'type': 'int',
             'value': 4,
             'step': 1},
+           {'name': 'Averaging',
+            'type': 'list',
+            'values': ('linear', 'exponential'),
+            'value': 'linear'},
+           {'name': 'RefreshTime',
+            'type': 'float',
+            'value': 1,
+            'step': 0.5,
+            'siPrefix': True,
+            'suffix': 's'},
            {'name': 'AcqTime',
             'readonly': True,
             'type': 'float',
@@ -320,7 +469,8 @@ PSDPars = ({'name': 'Fs',
             'suffix': 's'},
            )
 
-PSDParsList = ('Fs', 'nFFT', 'nAvg', 'nChannels', 'scaling')
+PSDParsList = ('Fs', 'nFFT', 'nAvg', 'nChannels', 'scaling', 'Averaging',
+               'RefreshTime')
 
 
 class PSDParameters(pTypes.GroupParameter):
@@ -371,20 +521,115 @@ class PSDParameters(pTypes.GroupParameter):
         return PSDKwargs
 
 
+class WelchPSD():
+    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling='density',
+                 Averaging='linear'):
+        '''Streaming Welch PSD. Each segment is transformed once when it is
+           completed. Same segments, window, overlap and scaling than
+           scipy.signal.welch with the default arguments.
+           Fs: float. Sampling Frequency
+           nFFT: int. Samples per segment
+           nAvg: int. With 'linear' averaging, the PSD is the mean of the last
+                      2*nAvg-1 segments, the same ones welch uses for
+                      nFFT*nAvg samples. With 'exponential' averaging the
+                      time constant is the same 2*nAvg-1 segments
+           nChannels: int. Number of channels
+           scaling: str. 'density' or 'spectrum'
+           Averaging: str. 'linear' or 'exponential'
+        '''
+        self.Fs = Fs
+        self.nFFT = nFFT
+        self.nChannels = nChannels
+        self.Averaging = Averaging
+        self.Step = nFFT - nFFT//2
+        self.nSegs = 2*nAvg - 1
+
+        self.Window = get_window('hann', nFFT)[:, None]
+        if scaling == 'density':
+            self.Scale = 1.0/(Fs*(self.Window**2).sum())
+        else:
+            self.Scale = 1.0/self.Window.sum()**2
+        self.ff = np.fft.rfftfreq(nFFT, 1/Fs)
+
+        self.SegBuf = np.zeros((nFFT, nChannels))
+        self.SegInd = 0
+        self.Pxx = np.zeros((self.nSegs, self.ff.size, nChannels))
+        self.PxxInd = 0
+        self.nDone = 0
+        self.PSD = np.zeros((self.ff.size, nChannels))
+
+    def AddData(self, NewData):
+        '''Returns the number of segments completed with NewData
+        '''
+        nNew = 0
+        ind = 0
+        while ind < NewData.shape[0]:
+            n = min(self.nFFT - self.SegInd, NewData.shape[0] - ind)
+            self.SegBuf[self.SegInd:self.SegInd + n, :] = NewData[ind:ind + n]
+            self.SegInd += n
+            ind += n
+            if self.SegInd == self.nFFT:
+                self._AddSegment(self.SegBuf)
+                self.SegBuf[:self.nFFT - self.Step] = self.SegBuf[self.Step:]
+                self.SegInd = self.nFFT - self.Step
+                nNew += 1
+        return nNew
+
+    def _AddSegment(self, Seg):
+        Seg = (Seg - Seg.mean(axis=0))*self.Window
+        Pxx = np.abs(np.fft.rfft(Seg, axis=0))**2
+        Pxx *= self.Scale
+        if self.nFFT % 2:
+            Pxx[1:] *= 2
+        else:
+            Pxx[1:-1] *= 2
+
+        if self.Averaging == 'exponential':
+            if self.nDone == 0:
+                self.PSD[:] = Pxx
+            else:
+                self.PSD += (Pxx - self.PSD)/self.nSegs
+        else:
+            self.Pxx[self.PxxInd] = Pxx
+            self.PxxInd = (self.PxxInd + 1) % self.nSegs
+        self.nDone += 1
+
+    def GetPSD(self):
+        if self.Averaging == 'linear':
+            nSegs = min(self.nDone, self.nSegs)
+            self.PSD[:] = self.Pxx[:nSegs].mean(axis=0)
+        return self.ff, self.PSD
+
+
 class PSDPlotter(Qt.QThread):
-    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling, ChannelConf):
+    def __init__(self, Fs, nFFT, nAvg, nChannels, scaling, ChannelConf,
+                 RefreshTime=1, Averaging='linear', ScalingCoeffs=None):
+        '''ScalingCoeffs: array. If given the blocks are raw int16 codes
+                                  scaled in this thread
+        '''
         super(PSDPlotter, self).__init__()
 
         self.scaling = scaling
         self.nFFT = 2**nFFT
         self.nChannels = nChannels
         self.Fs = Fs
-        self.BufferSize = self.nFFT * nAvg
-        self.Buffer = Buffer2D(self.Fs, self.nChannels,
-                               self.BufferSize/self.Fs)
+        self.RefreshTime = RefreshTime
+        self.ScalingCoeffs = ScalingCoeffs
+        self.PSD = WelchPSD(Fs=self.Fs,
+                            nFFT=self.nFFT,
+                            nAvg=nAvg,
+                            nChannels=self.nChannels,
+                            scaling=scaling,
+                            Averaging=Averaging)
+        self.Queue = BlockQueue(Depth=16,
+                                Policy='drop-oldest',
+                                Name='PSD')
+        self.Metrics = StageMetrics('PSD', self.Queue)
+        self.Profiler = ThreadProfiler('PSD', Wake=self.Queue.Wake)
 
         self.Plots = [None]*nChannels
         self.Curves = [None]*nChannels
+        self.Running = True
 
         self.wind = PgPlotWindow()
         self.wind.pgLayout.nextRow()
@@ -404,24 +649,36 @@ class PSDPlotter(Qt.QThread):
                 self.Curves[ch['Input']] = c
 
     def run(self, *args, **kwargs):
-        while True:
-            if self.Buffer.IsFilled():
-                ff, psd = welch(self.Buffer,
-                                fs=self.Fs,
-                                nperseg=self.nFFT,
-                                scaling=self.scaling,
-                                axis=0)
-                self.Buffer.Reset()
+        nNew = 0
+        LastRefresh = time.time()
+        while self.Running:
+            self.Profiler.Check()
+            NewData = self.Queue.Get(Wait=True, Timeout=self.RefreshTime)
+            self.Metrics.StartBlock()
+            if NewData is not None:
+                nNew += self.PSD.AddData(ScaleRaw(NewData,
+                                                  self.ScalingCoeffs))
+            Refresh = nNew and time.time() - LastRefresh >= self.RefreshTime
+            if Refresh:
+                ff, psd = self.PSD.GetPSD()
                 for i in range(self.nChannels):
                     self.Curves[i].setData(ff, psd[:, i])
-            else:
-                Qt.QThread.msleep(10)
+                nNew = 0
+                LastRefresh = time.time()
+                self.Metrics.AddRefresh()
+            if NewData is not None:
+                self.Metrics.EndBlock(NewData.shape[0], Block=NewData)
+            elif Refresh:
+                self.Metrics.EndBlock()
+        self.Profiler.Stop()
 
     def AddData(self, NewData):
-        self.Buffer.AddData(NewData)
+        self.Queue.Put(NewData)
 
     def stop(self):
+        self.Running = False
+        self.Queue.Close()
+        self.wait()
         self.wind.close()
-        self.terminate()
 
 
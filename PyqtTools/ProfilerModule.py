@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+On demand profiling of the worker threads of the pipeline
+"""
+
+import cProfile
+import logging
+import os
+import threading
+import time
+import pyqtgraph.parametertree.parameterTypes as pTypes
+
+
+log = logging.getLogger(__name__)
+
+# Poll time of the worker loops while a capture is pending or running
+CheckTime = 0.5
+
+
+class ThreadProfiler():
+    def __init__(self, Name, Wake=None):
+        '''cProfile capture of a worker thread. Start can be called from
+           any thread, the profiler is enabled and disabled by the worker
+           thread in Check, which costs one attribute test when idle.
+           Up to Python 3.11 only the worker thread is profiled. From
+           Python 3.12 cProfile is built on sys.monitoring, the capture
+           includes all the threads and only one capture can run at a
+           time in the process.
+
+           while self.Running:
+               self.Profiler.Check()
+               Block = self.Queue.Get(Wait=True,
+                                      Timeout=self.Profiler.GetTimeout())
+               ...
+           self.Profiler.Stop()
+
+           Name: str. Stage name
+           Wake: callable. Wakes up the blocking wait of the worker loop,
+                           so a capture requested while the stage is idle
+                           begins, BlockQueue.Wake or Event.set
+        '''
+        self.Name = Name
+        self.Wake = Wake
+        self.Requested = None
+        self.Profile = None
+        self.StopTime = None
+        self.FileName = None
+        self.LastFile = None
+        self.Done = threading.Event()
+
+    def Start(self, Duration, FileName):
+        '''Requests a capture of Duration seconds saved in FileName, the
+           capture begins in the next Check of the worker thread
+           Duration: float. Capture time (s)
+           FileName: str. Output file, read it with pstats or snakeviz
+        '''
+        self.Done.clear()
+        self.Requested = (Duration, FileName)
+        if self.Wake is not None:
+            self.Wake()
+
+    def Check(self):
+        if self.Requested is not None:
+            self._Begin()
+        elif self.Profile is not None and \
+                time.perf_counter() >= self.StopTime:
+            self.Stop()
+
+    def GetTimeout(self):
+        '''Timeout for the blocking waits of the worker loop, None when
+           idle so Check still runs when the stage stops receiving data
+        '''
+        if self.Requested is None and self.Profile is None:
+            return None
+        return CheckTime
+
+    def _Begin(self):
+        Duration, FileName = self.Requested
+        self.Requested = None
+        if self.Profile is not None:
+            self.Profile.disable()
+            self.Profile = None
+        Profile = cProfile.Profile()
+        try:
+            Profile.enable()
+        except ValueError as e:
+            # Another profiler is active (Python >= 3.12)
+            log.error('Profile of %s not started: %s', self.Name, e)
+            self.Done.set()
+            return
+        self.FileName = FileName
+        self.StopTime = time.perf_counter() + Duration
+        self.Profile = Profile
+
+    def Stop(self):
+        '''Ends the capture and saves it, must be called from the worker
+           thread, at the end of run
+        '''
+        if self.Profile is None:
+            return
+        self.Profile.disable()
+        try:
+            self.Profile.dump_stats(self.FileName)
+            self.LastFile = self.FileName
+            log.info('Profile of %s saved in %s', self.Name, self.FileName)
+        except OSError as e:
+            log.error('Error saving profile of %s: %s', self.Name, e)
+        self.Profile = None
+        self.Done.set()
+
+    def IsActive(self):
+        return self.Requested is not None or self.Profile is not None
+
+
+def GetProfileFileName(RecordFile, Name):
+    '''Profile file next to the recording
+       'Data/Test.h5' -> 'Data/Test_Demod_20261018_230245.prof'
+    '''
+    Base = os.path.splitext(RecordFile)[0]
+    return '{}_{}_{}.prof'.format(Base, Name,
+                                  time.strftime('%Y%m%d_%H%M%S'))
+
+
+ProfilerPars = ({'name': 'Stage',
+                 'type': 'list',
+                 'limits': []},
+                {'name': 'Duration',
+                 'type': 'float',
+                 'value': 10,
+                 'step': 1,
+                 'limits': (0.1, 3600),
+                 'siPrefix': True,
+                 'suffix': 's'},
+                {'name': 'RecordFile',
+                 'title': 'Record File',
+                 'type': 'str',
+                 'value': 'Profile'},
+                {'name': 'Capture',
+                 'type': 'action'},
+                {'name': 'LastFile',
+                 'title': 'Last Profile',
+                 'type': 'str',
+                 'readonly': True,
+                 'value': ''},)
+
+
+class ProfilerParameters(pTypes.GroupParameter):
+    def __init__(self, **kwargs):
+        '''Panel to capture a profile of a stage, the profile is saved
+           next to RecordFile
+
+           ProfPars = ProfilerParameters(name='Profiler')
+           ProfPars.AddStage(threadDemod.Profiler)
+           ProfPars.SetRecordFile(FileName)
+        '''
+        pTypes.GroupParameter.__init__(self, **kwargs)
+
+        self.addChildren(ProfilerPars)
+        self.Profilers = {}
+        self.param('Capture').sigActivated.connect(self.on_Capture)
+
+    def AddStage(self, Profiler):
+        self.Profilers[Profiler.Name] = Profiler
+        self.param('Stage').setLimits(list(self.Profilers.keys()))
+
+    def SetRecordFile(self, FileName):
+        self.param('RecordFile').setValue(FileName)
+
+    def on_Capture(self):
+        Name = self.param('Stage').value()
+        if Name not in self.Profilers:
+            log.error('No stage to profile')
+            return
+        Active = [n for n, p in self.Profilers.items() if p.IsActive()]
+        if Active:
+            log.error('Profile of %s still running', Active[0])
+            return
+        FileName = GetProfileFileName(self.param('RecordFile').value(), Name)
+        self.Profilers[Name].Start(self.param('Duration').value(), FileName)
+        self.param('LastFile').setValue(FileName)
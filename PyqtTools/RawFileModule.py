@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Raw recording files. A header of RawHeaderSize bytes with the magic
+string, the length of a json description and the description itself,
+followed by the samples in rows of nChannels values.
+"""
+
+import json
+import os
+import struct
+import time
+import numpy as np
+
+
+RawMagic = b'PYQTRAW1'
+RawHeaderSize = 4096
+
+
+def WriteRawHeader(File, Header):
+    Desc = json.dumps(Header).encode()
+    if len(Desc) + len(RawMagic) + 4 > RawHeaderSize:
+        raise ValueError('Raw header too long')
+    File.seek(0)
+    File.write(RawMagic + struct.pack('<I', len(Desc)) + Desc)
+
+
+def ReadRawHeader(FileName):
+    '''Returns the description of a raw file
+       {'nChannels': 16,
+        'dtype': '<f4',
+        'Fs': 1000.0,
+        'ChNames': ['Ch01', ...],
+        'ScalingCoeffs': None,
+        'nSamples': 100000,
+        'StartTime': 1571401512.3}
+    '''
+    with open(FileName, 'rb') as File:
+        Head = File.read(RawHeaderSize)
+    if not Head.startswith(RawMagic):
+        raise ValueError('{} is not a raw recording'.format(FileName))
+    nDesc, = struct.unpack('<I', Head[len(RawMagic):len(RawMagic) + 4])
+    Start = len(RawMagic) + 4
+    return json.loads(Head[Start:Start + nDesc].decode())
+
+
+def LoadRaw(FileName):
+    '''Returns a read only memory map (nSamples, nChannels) of a raw file
+       and its header. The file is preallocated by extents, so the samples
+       come from the header. After a crash the last FlushTime seconds of
+       RawFileBuffer may be missing
+    '''
+    Header = ReadRawHeader(FileName)
+    Data = np.memmap(FileName, dtype=np.dtype(Header['dtype']), mode='r',
+                     offset=RawHeaderSize,
+                     shape=(Header['nSamples'], Header['nChannels']))
+    return Data, Header
+
+
+class RawFileBuffer():
+    def __init__(self, FileName, nChannels, dtype='f4', Fs=None,
+                 ChNames=None, ScalingCoeffs=None, ExtentSize=256e6,
+                 FlushTime=1):
+        '''Saves the blocks in a preallocated memory mapped raw file. Has the
+           same interface than FileBuffer, see RawToH5 to convert the files.
+           FileName: str. Recording file name, the extension is changed to
+                          .raw
+           nChannels: int. Number of channels
+           dtype: str. Data type of the samples
+           Fs: float. Sampling Frequency, saved in the header
+           ChNames: list. Channel names, saved in the header
+           ScalingCoeffs: array. Scaling of raw int16 codes, saved in the
+                                 header, see BlockModule.ScaleRaw
+           ExtentSize: float. Bytes added to the file each time it is full
+           FlushTime: float. Max time (s) between updates of the number of
+                             samples in the header
+        '''
+        self.FileName = os.path.splitext(FileName)[0] + '.raw'
+        self.nChannels = nChannels
+        self.dtype = np.dtype(dtype)
+        self.RowBytes = nChannels*self.dtype.itemsize
+        self.ExtentRows = max(1, int(ExtentSize//self.RowBytes))
+        self.Header = {'nChannels': nChannels,
+                       'dtype': self.dtype.str,
+                       'Fs': Fs,
+                       'ChNames': ChNames,
+                       'ScalingCoeffs': None,
+                       'nSamples': 0,
+                       'StartTime': time.time()}
+        if ScalingCoeffs is not None:
+            self.Header['ScalingCoeffs'] = np.asarray(ScalingCoeffs).tolist()
+        self.nSamps = 0
+        self.BytesWritten = 0
+        self.Capacity = 0
+        self.Map = None
+        self.FlushTime = FlushTime
+        self.LastFlush = time.time()
+        self.File = open(self.FileName, 'w+b')
+        WriteRawHeader(self.File, self.Header)
+        self._Grow(self.ExtentRows)
+
+    def _Grow(self, nRows):
+        if self.Map is not None:
+            self.Map.flush()
+            del self.Map
+        self.Capacity += nRows
+        self.File.truncate(RawHeaderSize + self.Capacity*self.RowBytes)
+        self.Map = np.memmap(self.File, dtype=self.dtype, mode='r+',
+                             offset=RawHeaderSize,
+                             shape=(self.Capacity, self.nChannels))
+        self._UpdateHeader()
+
+    def _UpdateHeader(self):
+        self.Header['nSamples'] = self.nSamps
+        WriteRawHeader(self.File, self.Header)
+        self.File.flush()
+        self.LastFlush = time.time()
+
+    def AddSample(self, Sample):
+        nSamples = Sample.shape[0]
+        if self.nSamps + nSamples > self.Capacity:
+            Grow = -(-nSamples//self.ExtentRows)*self.ExtentRows
+            self._Grow(Grow)
+        self.Map[self.nSamps:self.nSamps + nSamples, :] = Sample
+        self.nSamps += nSamples
+        self.BytesWritten += nSamples*self.RowBytes
+        if time.time() - self.LastFlush > self.FlushTime:
+            self.Flush()
+
+    def Flush(self):
+        '''Writes the samples and then the header that counts them
+        '''
+        self.Map.flush()
+        self._UpdateHeader()
+
+    def Close(self):
+        '''Trims the preallocated extent and writes the final header
+        '''
+        self.Map.flush()
+        del self.Map
+        self.Map = None
+        self.File.truncate(RawHeaderSize + self.nSamps*self.RowBytes)
+        self._UpdateHeader()
+        self.File.close()
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the hot functions of the package at realistic sizes.
+Each run is appended to a history file in the home directory so the
+timings of different versions can be compared, and every kernel has an
+accuracy check against the reference implementation it replaces.
+
+    python benchmarks/KernelBenchmark.py
+    python benchmarks/KernelBenchmark.py --Kernels Demod Welch --Compare
+    python benchmarks/KernelBenchmark.py --ChecksOnly
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from scipy import signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PyqtTools.BlockModule import BlockPool
+from PyqtTools.MetricsModule import StageMetrics
+from PyqtTools.PlotModule import Buffer2D, WelchPSD
+from PyqtTools.DemodModule import (Filter, Demod, DemodBatch,
+                                   MultiStageDecimator, Channelizer,
+                                   DemodPool)
+from PyqtTools.FileModule import FileBuffer
+from PyqtTools.FileReaderModule import RecordReader
+
+HistoryFile = os.path.join(os.path.expanduser('~'),
+                           '.PyqtToolsKernelHistory.jsonl')
+Fs = 1e6
+
+
+def TimeIt(Func, MinTime=0.2, MaxRuns=200):
+    '''Calls Func until MinTime (s) is spent, returns the per call times
+    '''
+    Func()
+    Times = []
+    Start = time.perf_counter()
+    while len(Times) < MaxRuns and (time.perf_counter() - Start < MinTime or
+                                    len(Times) < 5):
+        t = time.perf_counter()
+        Func()
+        Times.append(time.perf_counter() - t)
+    return np.array(Times)
+
+
+def Signal(nSamps, nChannels, Seed=0):
+    Rng = np.random.default_rng(Seed)
+    t = np.arange(nSamps)[:, None]/Fs
+    return np.cos(2*np.pi*30e3*t) + 0.1*Rng.standard_normal((nSamps,
+                                                              nChannels))
+
+
+##############################################################################
+# Kernels, Setup(*Size) returns the function to time or the function and
+# a cleanup function
+
+
+def SetupBufferAdd(nChannels, Block, Circular=True):
+    Buff = Buffer2D(Fs, nChannels, 10*Block/Fs, Circular=Circular)
+    Data = Signal(Block, nChannels)
+    return lambda: Buff.AddData(Data)
+
+
+def SetupBufferAddLinear(nChannels, Block):
+    return SetupBufferAdd(nChannels, Block, Circular=False)
+
+
+def SetupGetTimes(Size):
+    Buff = Buffer2D(Fs, 1, Size/Fs)
+    Buff.totalind = 10*Size
+    return lambda: Buff.GetTimes(Size)
+
+
+def SetupFilter(nChannels, Block):
+    Filt = Filter(Fs, 5e3, 'lp', 2, nChannels=nChannels)
+    Data = Signal(Block, nChannels)
+    return lambda: Filt.Apply(Data)
+
+
+def GetCarriers(Fcs, Block):
+    t = np.arange(Block)/Fs
+    return np.stack([np.exp(-2j*np.pi*fc*t) for fc in Fcs], axis=1)
+
+
+def SetupDemod(nRows, nCols, Block):
+    # Per channel loop with the precomputed carriers, as the original code
+    Fcs = 30e3 + 5e3*np.arange(nCols)
+    Carriers = GetCarriers(Fcs, Block)
+    Dems = [[Demod(fc, Block, Fs, 100, 2, Carriers[:, ic])
+             for ic, fc in enumerate(Fcs)]
+            for r in range(nRows)]
+    Data = Signal(Block, nRows)
+
+    def Run():
+        for ir, Row in enumerate(Dems):
+            for Dem in Row:
+                Dem.Apply(Data[:, ir])
+    return Run
+
+
+def SetupDemodBatch(nRows, nCols, Block, NCO=False, DownFact=100,
+                    DecimMode='IIR'):
+    Fcs = 30e3 + 5e3*np.arange(nCols)
+    Carriers = None if NCO else GetCarriers(Fcs, Block)
+    Dem = DemodBatch(nCols, nRows, Fs, DownFact, 2, Carriers,
+                     DecimMode=DecimMode, Fcs=Fcs)
+    Data = Signal(Block, nRows)
+    return lambda: Dem.Apply(Data)
+
+
+def SetupDemodBatchNCO(nRows, nCols, Block):
+    return SetupDemodBatch(nRows, nCols, Block, NCO=True)
+
+
+def SetupDemodBatchOddFact(nRows, nCols, Block):
+    # DownFact that does not divide the block size
+    return SetupDemodBatch(nRows, nCols, Block, NCO=True, DownFact=300)
+
+
+def SetupDemodBatchMultiStage(nRows, nCols, Block):
+    return SetupDemodBatch(nRows, nCols, Block, NCO=True,
+                           DecimMode='MultiStage')
+
+
+def SetupMultiStage(nChannels, Block):
+    Decim = MultiStageDecimator(Fs, 100)
+    Data = Signal(Block, nChannels)
+    return lambda: Decim.Apply(Data)
+
+
+def SetupChannelizer(nRows, nCols, Block):
+    Fcs = 30e3 + 5e3*np.arange(nCols)
+    Chan = Channelizer(Fcs, nRows, Fs, 100)
+    Data = Signal(Block, nRows)
+    return lambda: Chan.Apply(Data)
+
+
+def SetupDemodPool(nRows, nCols, Block, nProcs=2):
+    Fcs = 30e3 + 5e3*np.arange(nCols)
+    Pool = DemodPool(nProcs, nRows, Block, Engine='Mixer', Fcs=list(Fcs),
+                     Fs=Fs, DownFact=100, Order=2, Signal=None)
+    Data = Signal(Block, nRows)
+    return (lambda: Pool.Apply(Data)), Pool.Close
+
+
+def SetupWelch(nChannels, nFFT, nAvg):
+    Data = Signal(nFFT*nAvg, nChannels)
+    return lambda: signal.welch(Data, Fs, nperseg=nFFT, axis=0)
+
+
+def SetupWelchPSD(nChannels, nFFT, nAvg):
+    # One refresh, a new block of nFFT samples and the PSD
+    PSD = WelchPSD(Fs, nFFT, nAvg, nChannels)
+    PSD.AddData(Signal(nFFT*nAvg, nChannels))
+    Data = Signal(nFFT, nChannels)
+
+    def Run():
+        PSD.AddData(Data)
+        PSD.GetPSD()
+    return Run
+
+
+def SetupFileBuffer(nChannels, Block, Compression='gzip'):
+    Dir = tempfile.mkdtemp()
+    FileBuff = FileBuffer(os.path.join(Dir, 'Bench.h5'), None, nChannels,
+                          Compression=Compression)
+    Data = Signal(Block, nChannels).astype('f4')
+
+    def Cleanup():
+        FileBuff.Close()
+        shutil.rmtree(Dir)
+    return (lambda: FileBuff.AddSample(Data)), Cleanup
+
+
+def SetupFileBufferNone(nChannels, Block):
+    return SetupFileBuffer(nChannels, Block, Compression='none')
+
+
+def SetupSaveACDict(nChannels, nFFT):
+    from PyqtTools.SaveDictsModule import SaveDicts
+    Chs = {'Ch{0:02d}Col1'.format(i): i for i in range(nChannels)}
+    Saver = SaveDicts(np.array([0.1, ]), np.linspace(0, -0.3, 4), Chs,
+                      int(np.log2(nFFT)), 5e3)
+    ff = np.fft.rfftfreq(nFFT, 1/5e3)
+    psd = np.random.rand(ff.size, nChannels)
+    return lambda: Saver.SaveACDict(psd, ff, 1, 0)
+
+
+Kernels = {'Buffer2D.AddData': (SetupBufferAdd,
+                                [(16, 1000), (32, 20000), (64, 100000)]),
+           'Buffer2D.AddData linear': (SetupBufferAddLinear,
+                                       [(16, 1000), (32, 20000),
+                                        (64, 100000)]),
+           'Buffer2D.GetTimes': (SetupGetTimes, [(10**4, ), (10**6, )]),
+           'Filter.Apply': (SetupFilter, [(1, 20000), (32, 20000)]),
+           'Demod.Apply': (SetupDemod, [(8, 2, 20000), (32, 2, 20000)]),
+           'DemodBatch.Apply': (SetupDemodBatch,
+                                [(8, 2, 20000), (32, 2, 20000)]),
+           'DemodBatch.Apply NCO': (SetupDemodBatchNCO,
+                                    [(8, 2, 20000), (32, 2, 20000)]),
+           'DemodBatch.Apply DownFact 300': (SetupDemodBatchOddFact,
+                                             [(8, 2, 20000),
+                                              (32, 2, 20000)]),
+           'DemodBatch.Apply MultiStage': (SetupDemodBatchMultiStage,
+                                           [(8, 2, 20000), (32, 2, 20000)]),
+           'MultiStageDecimator.Apply': (SetupMultiStage,
+                                         [(1, 20000), (32, 20000)]),
+           'Channelizer.Apply': (SetupChannelizer,
+                                 [(8, 2, 20000), (32, 2, 20000)]),
+           'DemodPool.Apply': (SetupDemodPool,
+                               [(8, 2, 20000), (32, 2, 20000)]),
+           'welch': (SetupWelch, [(8, 2**15, 4), (32, 2**15, 4)]),
+           'WelchPSD': (SetupWelchPSD, [(8, 2**15, 4), (32, 2**15, 4)]),
+           'FileBuffer.AddSample': (SetupFileBuffer,
+                                    [(16, 20000), (64, 20000)]),
+           'FileBuffer.AddSample none': (SetupFileBufferNone,
+                                         [(16, 20000), (64, 20000)]),
+           'SaveDicts.SaveACDict': (SetupSaveACDict, [(32, 2**15), ]),
+           }
+
+
+##############################################################################
+# Accuracy checks, return the max error and the tolerance
+
+
+def CheckBuffer2D():
+    Circ = Buffer2D(Fs, 4, 5000/Fs, Circular=True)
+    Lin = Buffer2D(Fs, 4, 5000/Fs, Circular=False)
+    # The samples not written yet are not initialized
+    Circ[:] = 0
+    Lin[:] = 0
+    Rng = np.random.default_rng(1)
+    Err = 0
+    for i in range(50):
+        Data = Rng.standard_normal((Rng.integers(1, 5001), 4))
+        Circ.AddData(Data)
+        Lin.AddData(Data)
+        Size = Rng.integers(1, 5001)
+        Err = max(Err, np.abs(Circ.GetData(Size) - Lin[-Size:]).max())
+    return Err, 0
+
+
+def CheckGetTimes():
+    Buff = Buffer2D(Fs, 1, 1e5/Fs)
+    Buff.totalind = 123456
+    Times = Buff.GetTimes(10**5)
+    Ref = (Buff.totalind - 10**5 + np.arange(10**5))/Fs
+    return np.abs(Times - Ref).max(), 1e-9
+
+
+def CheckFilter():
+    Data = Signal(50000, 4)
+    Filt = Filter(Fs, 5e3, 'lp', 2, nChannels=4)
+    Blocks = np.concatenate([Filt.Apply(Data[i:i + 7000])
+                             for i in range(0, 50000, 7000)])
+    Ref, _ = signal.lfilter(Filt.b, Filt.a, Data, axis=0,
+                            zi=signal.lfilter_zi(Filt.b, Filt.a)[:, None] *
+                            np.ones((1, 4)))
+    return np.abs(Blocks - Ref).max(), 1e-12
+
+
+def RefDemod(Sig, Fc, DownFact, Order):
+    '''Original demodulation of a whole 1D signal, mixed with the carrier
+       and the real and imaginary parts filtered separately at full rate
+    '''
+    t = np.arange(Sig.shape[0])/Fs
+    Mixed = np.exp(-2j*np.pi*Fc*t)*Sig
+    b, a = signal.butter(Order, (Fs/DownFact/2)/(0.5*Fs), 'lp')
+    zi = signal.lfilter_zi(b, a)
+    R, _ = signal.lfilter(b, a, np.real(Mixed), zi=zi)
+    I, _ = signal.lfilter(b, a, np.imag(Mixed), zi=zi)
+    return (R + 1j*I)[::DownFact]
+
+
+def CheckDemodBatch():
+    Fcs = [30e3, 35e3]
+    Data = Signal(60000, 3)
+    Batch = DemodBatch(2, 3, Fs, 100, 2, None, Fcs=Fcs)
+    Out = np.concatenate([Batch.Apply(Data[i:i + 20000])
+                          for i in range(0, 60000, 20000)])
+    Ref = np.stack([RefDemod(Data[:, ir], fc, 100, 2)
+                    for ir in range(3) for fc in Fcs], axis=1)
+    return np.abs(Out - Ref).max(), 1e-9
+
+
+def CheckDemodNCO():
+    Block = 20000
+    t = np.arange(Block)/Fs
+    Table = np.exp(-2j*np.pi*30e3*t)
+    Dem = Demod(30e3, Block, Fs, 100, 2, None)
+    DemTab = Demod(30e3, Block, Fs, 100, 2, Table)
+    Data = Signal(3*Block, 1)[:, 0]
+    Ref = RefDemod(Data, 30e3, 100, 2)
+    Err = 0
+    for Dm in (Dem, DemTab):
+        Out = np.concatenate([Dm.Apply(Data[i:i + Block])
+                              for i in range(0, 3*Block, Block)])
+        Err = max(Err, np.abs(Out - Ref).max())
+    return Err, 1e-9
+
+
+def CheckDemodOddFact():
+    # Blocks that DownFact does not divide, with NCO carriers
+    Fcs = [30e3, 35e3]
+    Data = Signal(63000, 2)
+    Batch = DemodBatch(2, 2, Fs, 300, 2, None, Fcs=Fcs)
+    Out = np.concatenate([Batch.Apply(Data[i:i + 7000])
+                          for i in range(0, 63000, 7000)])
+    Ref = np.stack([RefDemod(Data[:, ir], fc, 300, 2)
+                    for ir in range(2) for fc in Fcs], axis=1)
+    return np.abs(Out - Ref).max(), 1e-9
+
+
+def CheckMultiStage():
+    # By irregular blocks, some shorter than the first stage factor,
+    # against each stage filtered at full rate and decimated
+    Data = Signal(60000, 3)
+    Decim = MultiStageDecimator(Fs, 100)
+    Sizes = [1, 13, 7000, 5, 20000, 99, 100]
+    Bounds = np.cumsum([0] + Sizes + [60000 - sum(Sizes)])
+    Out = np.concatenate([Decim.Apply(Data[a:b])
+                          for a, b in zip(Bounds[:-1], Bounds[1:])])
+    Ref = Data
+    for Stage in Decim.Stages:
+        Ref = signal.lfilter(Stage.Taps, 1, Ref, axis=0)[::Stage.DownFact]
+    return np.abs(Out - Ref).max(), 1e-12
+
+
+def CheckChannelizer():
+    # Against the mixing with each carrier, the prototype FIR filter at
+    # full rate and the decimation
+    Fcs = [30e3, 35e3]
+    Data = Signal(60000, 2)
+    Chan = Channelizer(Fcs, 2, Fs, 100)
+    Out = np.concatenate([Chan.Apply(Data[i:i + 7000])
+                          for i in range(0, 60000, 7000)])
+    Taps = Chan.PolyTaps.ravel()[::-1]
+    t = np.arange(60000)/Fs
+    Ref = np.stack([signal.lfilter(Taps, 1, Data[:, ir] *
+                                   np.exp(-2j*np.pi*fc*t))[::100]
+                    for ir in range(2) for fc in Fcs], axis=1)
+    return np.abs(Out - Ref).max(), 1e-9
+
+
+def CheckDemodPool():
+    Fcs = [30e3, 35e3]
+    Data = Signal(60000, 4)
+    Kwargs = {'Fcs': Fcs, 'Fs': Fs, 'DownFact': 100, 'Order': 2,
+              'Signal': None}
+    Pool = DemodPool(2, 4, 20000, Engine='Mixer', **Kwargs)
+    Batch = DemodBatch(2, 4, Fs, 100, 2, None, Fcs=Fcs)
+    Err = 0
+    try:
+        for i in range(0, 60000, 20000):
+            Out = Pool.Apply(Data[i:i + 20000])
+            Err = max(Err, np.abs(Out - Batch.Apply(Data[i:i + 20000])).max())
+    finally:
+        Pool.Close()
+    return Err, 0
+
+
+def CheckWelchPSD():
+    Data = Signal(2**15*4, 4)
+    PSD = WelchPSD(Fs, 2**15, 4, 4)
+    for i in range(0, Data.shape[0], 10000):
+        PSD.AddData(Data[i:i + 10000])
+    ff, psd = PSD.GetPSD()
+    fref, Ref = signal.welch(Data, Fs, nperseg=2**15, axis=0)
+    return np.abs(psd - Ref).max()/np.abs(Ref).max(), 1e-10
+
+
+def CheckFileBuffer():
+    Dir = tempfile.mkdtemp()
+    Data = Signal(100000, 8).astype('f4')
+    Err = 0
+    for Comp, Threads in (('gzip', 0), ('shuffle+gzip', 2), ('lzf', 0),
+                          ('shuffle+lzf', 0), ('none', 0)):
+        Name = os.path.join(Dir, 'Check{}{}.h5'.format(Comp, Threads))
+        FileBuff = FileBuffer(Name, None, 8, Compression=Comp,
+                              CompressThreads=Threads)
+        for i in range(0, 100000, 7000):
+            FileBuff.AddSample(Data[i:i + 7000])
+        FileBuff.Close()
+        with RecordReader(Name) as Reader:
+            Err = max(Err, np.abs(Reader[:] - Data).max())
+    shutil.rmtree(Dir)
+    return Err, 0
+
+
+def CheckSaveACDict():
+    from PyqtTools.SaveDictsModule import SaveDicts
+    Chs = {'Ch01Col1': 0, 'Ch02Col1': 1}
+    Saver = SaveDicts(np.array([0.1, ]), np.linspace(0, -0.3, 4), Chs, 8, 5e3)
+    ff = np.fft.rfftfreq(2**8, 1/5e3)
+    psd = np.random.rand(ff.size, 2)
+    Saver.SaveACDict(psd, ff, 2, 0)
+    Err = 0
+    for ch, ind in Chs.items():
+        Saved = Saver.DevACVals[ch]['PSD']['Vd0'][2]
+        Err = max(Err, np.abs(Saved - psd[:, ind]).max())
+    return Err, 0
+
+
+def CheckMetricsGaps():
+    # Blocks 0 and 1 are overwritten by 4 and 5 before being used, 3 is
+    # lost in a queue and 2, 4 and 5 arrive in time
+    Pool = BlockPool(4, (10, 2))
+    Blocks = [Pool.Next(SeqNum=i) for i in range(6)]
+    Metrics = StageMetrics('Check')
+    for i in (0, 1, 2, 4, 5):
+        Metrics.StartBlock()
+        Metrics.EndBlock(10, Block=Blocks[i])
+    Stats = Metrics.GetStats()
+    return abs(Stats['Gaps'] - 3) + abs(Stats['Overruns'] - 2), 0
+
+
+Checks = {'Buffer2D circular equals linear': CheckBuffer2D,
+          'Buffer2D.GetTimes': CheckGetTimes,
+          'Filter.Apply by blocks equals lfilter': CheckFilter,
+          'DemodBatch equals original Demod': CheckDemodBatch,
+          'Demod NCO and carrier table equal original Demod': CheckDemodNCO,
+          'DemodBatch DownFact 300 equals original Demod': CheckDemodOddFact,
+          'MultiStageDecimator equals FIR stages': CheckMultiStage,
+          'Channelizer equals FIR demodulation': CheckChannelizer,
+          'DemodPool equals DemodBatch': CheckDemodPool,
+          'WelchPSD equals welch': CheckWelchPSD,
+          'FileBuffer read back': CheckFileBuffer,
+          'SaveDicts.SaveACDict': CheckSaveACDict,
+          'StageMetrics counts overruns as gaps': CheckMetricsGaps,
+          }
+
+
+##############################################################################
+
+
+def RunChecks(Names=None):
+    Results = {}
+    for Name, Check in Checks.items():
+        if Names and not any(Name.startswith(n) for n in Names):
+            continue
+        try:
+            Err, Tol = Check()
+            Results[Name] = {'Error': float(Err), 'Tol': Tol,
+                             'Pass': bool(Err <= Tol)}
+        except ImportError as e:
+            Results[Name] = {'Skipped': str(e)}
+        print('{:40s} {}'.format(Name, Results[Name]))
+    return Results
+
+
+def RunKernels(Names=None, MinTime=0.2):
+    Results = {}
+    for Name, (Setup, Sizes) in Kernels.items():
+        if Names and not any(Name.startswith(n) for n in Names):
+            continue
+        Results[Name] = {}
+        for Size in Sizes:
+            Key = 'x'.join(str(s) for s in Size)
+            try:
+                Func = Setup(*Size)
+            except ImportError as e:
+                Results[Name][Key] = {'Skipped': str(e)}
+                print('{:32s} {:16s} skipped, {}'.format(Name, Key, e))
+                continue
+            Cleanup = None
+            if isinstance(Func, tuple):
+                Func, Cleanup = Func
+            Times = TimeIt(Func, MinTime=MinTime)
+            if Cleanup is not None:
+                Cleanup()
+            Results[Name][Key] = {'Median': float(np.median(Times)),
+                                  'Min': float(Times.min()),
+                                  'IQR': float(np.subtract(
+                                      *np.percentile(Times, [75, 25]))),
+                                  'Runs': int(Times.size)}
+            print('{:32s} {:16s} {:10.3f} ms'.format(
+                Name, Key, 1e3*Results[Name][Key]['Median']))
+    return Results
+
+
+def GetVersion():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def LoadHistory(FileName=HistoryFile):
+    if not os.path.isfile(FileName):
+        return []
+    with open(FileName) as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+def Compare(Run, Ref):
+    '''Prints the speed up of Run against a previous Ref run
+    '''
+    print('Compared with {} ({})'.format(Ref['Version'], Ref['Date']))
+    for Name, Sizes in Run['Kernels'].items():
+        for Key, Res in Sizes.items():
+            Old = Ref['Kernels'].get(Name, {}).get(Key, {})
+            if 'Median' not in Res or 'Median' not in Old:
+                continue
+            print('{:32s} {:16s} {:6.2f}x'.format(
+                Name, Key, Old['Median']/Res['Median']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--Kernels', nargs='+', default=None,
+                        help='Names or prefixes of the kernels to run')
+    parser.add_argument('--MinTime', type=float, default=0.2,
+                        help='Minimum time (s) spent timing each size')
+    parser.add_argument('--ChecksOnly', action='store_true')
+    parser.add_argument('--Compare', action='store_true',
+                        help='Compare with the last run in the history')
+    parser.add_argument('--History', default=HistoryFile)
+    parser.add_argument('--NoSave', action='store_true')
+    Args = parser.parse_args(argv)
+
+    ChecksRes = RunChecks(Args.Kernels)
+    Failed = [n for n, r in ChecksRes.items() if r.get('Pass') is False]
+    if Failed:
+        print('Accuracy checks failed: {}'.format(', '.join(Failed)))
+    if Args.ChecksOnly:
+        return 1 if Failed else 0
+
+    Run = {'Version': GetVersion(),
+           'Date': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'System': {'Platform': platform.platform(),
+                      'Python': platform.python_version(),
+                      'Numpy': np.__version__,
+                      'CPUs': os.cpu_count()},
+           'Checks': ChecksRes,
+           'Kernels': RunKernels(Args.Kernels, Args.MinTime)}
+
+    History = LoadHistory(Args.History)
+    if Args.Compare and History:
+        Compare(Run, History[-1])
+    if not Args.NoSave:
+        with open(Args.History, 'a') as f:
+            f.write(json.dumps(Run) + '\n')
+        print('Results appended to {}'.format(Args.History))
+    return 1 if Failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
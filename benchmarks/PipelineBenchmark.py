@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+End to end benchmark of the acquisition pipeline. The simulated DAQ card
+feeds DemodThread, DataSavingThread and a Buffer2D consumer thread like in
+an acquisition, and the throughput, per block latency, CPU time and drops
+of each stage are saved as json.
+
+    python benchmarks/PipelineBenchmark.py --Fs 1e6 --nChannels 8 16 32
+        --EverySamps 20000 --DSFact 100 --Duration 10 --Out bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PyqtTools.BlockModule import BlockQueue
+from PyqtTools.DaqSimulated import ReadAnalog
+from PyqtTools.DemodModule import DemodThread
+from PyqtTools.FileModule import DataSavingThread
+from PyqtTools.PlotModule import Buffer2D
+
+
+class StageProbe():
+    def __init__(self, Name, Queue):
+        '''Measures a stage from the calls to the Get of its input queue,
+           the time between a Get that returns a block and the next Get
+           is the processing of that block in the stage thread, the
+           latency is taken from the AcqTime of the DataBlocks
+           Name: str. Stage name
+           Queue: BlockQueue. Input queue of the stage
+        '''
+        self.Name = Name
+        self.Queue = Queue
+        self.QueueGet = Queue.Get
+        Queue.Get = self.Get
+        self.Latency = []
+        self.CpuTime = 0
+        self.BusyTime = 0
+        self.nBlocks = 0
+        self.nSamps = 0
+        self.Current = None
+
+    def Get(self, *args, **kwargs):
+        if self.Current is not None:
+            Start, Cpu, AcqTime = self.Current
+            Stop = time.perf_counter()
+            self.CpuTime += time.thread_time() - Cpu
+            self.BusyTime += Stop - Start
+            if AcqTime is not None:
+                self.Latency.append(time.time() - AcqTime)
+            self.Current = None
+        Block = self.QueueGet(*args, **kwargs)
+        if Block is not None:
+            self.Current = (time.perf_counter(), time.thread_time(),
+                            getattr(Block, 'AcqTime', None))
+            self.nBlocks += 1
+            self.nSamps += Block.shape[0]
+        return Block
+
+    def Results(self, WallTime):
+        Lat = np.array(self.Latency)*1e3
+        Res = {'Blocks': self.nBlocks,
+               'SampsPerSec': self.nSamps/WallTime,
+               'CpuTime': self.CpuTime,
+               'CpuLoad': self.CpuTime/WallTime,
+               'BusyLoad': self.BusyTime/WallTime,
+               'LatencyMs': {}}
+        if Lat.size:
+            for Perc in (50, 90, 99, 100):
+                Res['LatencyMs']['p{}'.format(Perc)] = \
+                    float(np.percentile(Lat, Perc))
+        Res['Queue'] = self.Queue.GetCounters()
+        return Res
+
+
+class BufferConsumer(threading.Thread):
+    def __init__(self, Fs, nChannels, ViewBuffer, QueueDepth, QueuePolicy):
+        '''Plotting consumer without GUI, adds the blocks to a circular
+           Buffer2D and reads the view as the Plotter thread does
+        '''
+        super(BufferConsumer, self).__init__(daemon=True)
+        self.Buffer = Buffer2D(Fs, nChannels, ViewBuffer, Circular=True)
+        self.Queue = BlockQueue(QueueDepth, QueuePolicy, 'Buffer')
+        self.Running = True
+
+    def run(self):
+        while self.Running:
+            Block = self.Queue.Get(Wait=True)
+            if Block is not None:
+                self.Buffer.AddData(Block)
+                self.Buffer.GetData(self.Buffer.shape[0])
+
+    def AddData(self, Block):
+        self.Queue.Put(Block)
+
+    def stop(self):
+        self.Running = False
+        self.Queue.Close()
+        self.join()
+
+
+def RunPipeline(Fs=1e6, nChannels=8, EverySamps=20000, DSFact=100,
+                Fcs=(30e3, 35e3), Duration=10, RealTime=True,
+                Compression='gzip', RawInt16=False, QueueDepth=8,
+                QueuePolicy='drop-oldest', Stages=('demod', 'save', 'buffer'),
+                PoolSize=32, Dir=None):
+    '''Runs the pipeline for Duration seconds and returns the results
+    '''
+    Conf = dict(locals())
+    Conf.pop('Dir')
+    Rows = ['Ch{0:02d}'.format(i) for i in range(nChannels)]
+    Probes = {}
+    Consumers = {}
+
+    Daq = ReadAnalog(Rows, RawInt16=RawInt16, RealTime=RealTime,
+                     Fcs=Fcs, NoiseRms=1e-3, Seed=0)
+
+    if 'demod' in Stages:
+        Demod = DemodThread(Fcs={'Col{}'.format(i): fc
+                                 for i, fc in enumerate(Fcs)},
+                            RowList=Rows,
+                            FetchSize=EverySamps,
+                            FsDemod=Fs,
+                            DSFact=DSFact,
+                            FiltOrder=2,
+                            Signal=None,
+                            Gain=1e4,
+                            QueueDepth=QueueDepth,
+                            QueuePolicy=QueuePolicy,
+                            PoolSize=PoolSize,
+                            ScalingCoeffs=Daq.ScalingCoeffs if RawInt16
+                            else None)
+        Consumers['demod'] = Demod
+
+    if 'save' in Stages:
+        FileName = os.path.join(Dir or tempfile.gettempdir(),
+                                'PipelineBenchmark.h5')
+        Save = DataSavingThread(FileName, nChannels,
+                                dtype='i2' if RawInt16 else 'f4',
+                                Compression=Compression,
+                                Fs=Fs,
+                                QueueDepth=QueueDepth,
+                                QueuePolicy=QueuePolicy,
+                                PoolSize=PoolSize)
+        Consumers['save'] = Save
+
+    if 'buffer' in Stages:
+        Buff = BufferConsumer(Fs, nChannels, 10*EverySamps/Fs,
+                              QueueDepth, QueuePolicy)
+        Consumers['buffer'] = Buff
+
+    for Name, Cons in Consumers.items():
+        Probes[Name] = StageProbe(Name, Cons.Queue)
+
+    Acq = {'nBlocks': 0, 'nSamps': 0, 'CpuTime': 0}
+
+    def EveryNEvent(Block):
+        Cpu = time.thread_time()
+        for Cons in Consumers.values():
+            Cons.AddData(Block)
+        Acq['CpuTime'] += time.thread_time() - Cpu
+        Acq['nBlocks'] += 1
+        Acq['nSamps'] += Block.shape[0]
+
+    Daq.EveryNEvent = EveryNEvent
+    for Cons in Consumers.values():
+        Cons.start()
+
+    ProcCpu = time.process_time()
+    Start = time.perf_counter()
+    Daq.ReadContData(Fs, EverySamps, PoolSize=PoolSize)
+    time.sleep(Duration)
+    Daq.StopContData()
+    WallTime = time.perf_counter() - Start
+    for Cons in Consumers.values():
+        Cons.stop()
+    ProcCpu = time.process_time() - ProcCpu
+
+    Results = {'Config': Conf,
+               'WallTime': WallTime,
+               'ProcessCpuLoad': ProcCpu/WallTime,
+               'AcqSampsPerSec': Acq['nSamps']/WallTime,
+               'AcqBlocks': Acq['nBlocks'],
+               'AcqCpuTime': Acq['CpuTime'],
+               'Stages': {}}
+    Sustained = True
+    for Name, Probe in Probes.items():
+        Res = Probe.Results(WallTime)
+        Res['Lost'] = Acq['nBlocks'] - Probe.nBlocks
+        Sustained = Sustained and Res['Lost'] <= QueueDepth and \
+            Res['Queue']['Dropped'] == 0
+        Results['Stages'][Name] = Res
+    Results['Sustained'] = Sustained
+    if 'save' in Stages and os.path.isfile(FileName):
+        os.remove(FileName)
+    return Results
+
+
+def GetSystemInfo():
+    return {'Platform': platform.platform(),
+            'Python': platform.python_version(),
+            'Numpy': np.__version__,
+            'CPUs': os.cpu_count(),
+            'Date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--Fs', type=float, nargs='+', default=[1e6, ])
+    parser.add_argument('--nChannels', type=int, nargs='+', default=[8, ])
+    parser.add_argument('--EverySamps', type=int, default=20000)
+    parser.add_argument('--DSFact', type=int, default=100)
+    parser.add_argument('--Fcs', type=float, nargs='+',
+                        default=[30e3, 35e3])
+    parser.add_argument('--Duration', type=float, default=10)
+    parser.add_argument('--Fast', action='store_true',
+                        help='Generate the blocks as fast as possible')
+    parser.add_argument('--Compression', default='gzip')
+    parser.add_argument('--RawInt16', action='store_true')
+    parser.add_argument('--QueueDepth', type=int, default=8)
+    parser.add_argument('--QueuePolicy', default='drop-oldest')
+    parser.add_argument('--Stages', nargs='+',
+                        default=['demod', 'save', 'buffer'])
+    parser.add_argument('--Out', default='PipelineBenchmark.json')
+    Args = parser.parse_args(argv)
+
+    Runs = []
+    for Fs in Args.Fs:
+        for nChannels in Args.nChannels:
+            Res = RunPipeline(Fs=Fs,
+                              nChannels=nChannels,
+                              EverySamps=Args.EverySamps,
+                              DSFact=Args.DSFact,
+                              Fcs=Args.Fcs,
+                              Duration=Args.Duration,
+                              RealTime=not Args.Fast,
+                              Compression=Args.Compression,
+                              RawInt16=Args.RawInt16,
+                              QueueDepth=Args.QueueDepth,
+                              QueuePolicy=Args.QueuePolicy,
+                              Stages=Args.Stages)
+            print('Fs {:.3g} nChannels {} Sustained {}'.format(
+                Fs, nChannels, Res['Sustained']))
+            for Name, Stage in Res['Stages'].items():
+                print('    {:8s} {:10.3g} Samps/s  CPU {:5.1%}  '
+                      'p99 {:8.2f} ms  Dropped {}'.format(
+                          Name, Stage['SampsPerSec'], Stage['CpuLoad'],
+                          Stage['LatencyMs'].get('p99', np.nan),
+                          Stage['Queue']['Dropped']))
+            Runs.append(Res)
+
+    with open(Args.Out, 'w') as f:
+        json.dump({'System': GetSystemInfo(), 'Runs': Runs}, f, indent=2)
+    print('Results saved in {}'.format(Args.Out))
+
+
+if __name__ == '__main__':
+    main()